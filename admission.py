@@ -0,0 +1,294 @@
+"""Admission control for the expensive routes: rate limits and concurrency caps.
+
+ROUTE_CLASSES groups routes into classes: "cpu" for the bcrypt routes
+(/login, /register) and "io" for the file uploads. AdmissionMiddleware
+checks every request of a class before the route reads its body:
+
+1. Token buckets per client address and per user (the bearer token's
+   subject, or the credentials themselves when they do not verify). An empty
+   bucket answers 429 with Retry-After set to when its next token arrives.
+2. A cap on the requests of the class running at once in this worker. A
+   request over the cap waits up to ADMISSION_QUEUE_SECONDS for a slot and
+   then gets a 503 with Retry-After.
+
+The buckets live in this process by default; ADMISSION_BACKEND_URL=redis://...
+shares them between workers. The concurrency caps stay per worker, like the
+CPU and connections they protect. A failing backend admits requests rather
+than taking the routes down with it.
+"""
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import Counter, defaultdict
+from typing import NamedTuple
+
+from jose import JWTError, jwt
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Match
+
+import auth
+import database
+import hashing
+from cache import TTLCache
+
+logger = logging.getLogger("admission")
+
+# Admission settings
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"
+ADMISSION_BACKEND_URL = os.getenv("ADMISSION_BACKEND_URL", "")
+ADMISSION_QUEUE_SECONDS = float(os.getenv("ADMISSION_QUEUE_SECONDS", 2))
+BUCKET_CACHE_SIZE = 100_000
+
+
+class RouteClass(NamedTuple):
+    concurrency: int  # Requests running at once per worker, 0 for no cap
+    ip_rate: float  # Requests per second per client address, 0 for no limit
+    ip_burst: int
+    user_rate: float  # Requests per second per user, 0 for no limit
+    user_burst: int
+
+
+CLASSES = {
+    # Nobody has a token yet when logging in, so only addresses are limited. A
+    # whole class may log in at once from behind one campus NAT address: the
+    # burst covers that, and the concurrency cap still bounds the bcrypt work
+    "cpu": RouteClass(
+        concurrency=int(os.getenv("ADMISSION_CPU_CONCURRENCY", hashing.HASH_WORKERS * 2)),
+        ip_rate=float(os.getenv("ADMISSION_CPU_IP_RATE", 10)),
+        ip_burst=int(os.getenv("ADMISSION_CPU_IP_BURST", 60)),
+        user_rate=0,
+        user_burst=0,
+    ),
+    "io": RouteClass(
+        concurrency=int(os.getenv("ADMISSION_IO_CONCURRENCY", 16)),
+        ip_rate=float(os.getenv("ADMISSION_IO_IP_RATE", 5)),
+        ip_burst=int(os.getenv("ADMISSION_IO_IP_BURST", 30)),
+        user_rate=float(os.getenv("ADMISSION_IO_USER_RATE", 1)),
+        user_burst=int(os.getenv("ADMISSION_IO_USER_BURST", 10)),
+    ),
+}
+
+# (method, route template) -> class
+ROUTE_CLASSES = {
+    ("POST", "/login"): "cpu",
+    ("POST", "/register"): "cpu",
+    ("POST", "/submission/{assessment_id}"): "io",
+    ("POST", "/subjects/{subject_id}/assessments"): "io",
+    ("POST", "/subjects/{subject_id}/students/csv"): "io",
+}
+
+
+class LocalBuckets:
+    """Token buckets in this process only."""
+
+    def __init__(self, maxsize: int):
+        # An idle bucket is full again after burst / rate seconds, so it can be forgotten then
+        self.buckets = TTLCache(maxsize=maxsize, ttl=3600)
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        """Seconds until a token is available; 0 means one was taken."""
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key) or (burst, now)
+        tokens = min(burst, tokens + (now - updated) * rate)
+        wait = 0.0 if tokens >= 1 else (1 - tokens) / rate
+        if not wait:
+            tokens -= 1
+        self.buckets.set(key, (tokens, now), ttl=burst / rate)
+        return wait
+
+    def stats(self):
+        return {"backend": "local", **self.buckets.stats()}
+
+
+class RedisBuckets:
+    """Token buckets shared by every worker through Redis, updated atomically by a script."""
+
+    SCRIPT = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local rate, burst = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens')) or burst
+    local updated = tonumber(redis.call('HGET', KEYS[1], 'updated')) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+    redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str, prefix: str = "devclassroom:admission:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("A redis:// admission backend URL needs the redis package (pip install redis)") from e
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+        self.prefix = prefix
+
+    async def take(self, key: str, rate: float, burst: int) -> float:
+        return float(await self.script(keys=[self.prefix + key], args=[rate, burst]))
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+def backend_from_url(url: str):
+    if not url or url == "local":
+        return LocalBuckets(BUCKET_CACHE_SIZE)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBuckets(url)
+    raise ValueError(f"Unsupported admission backend URL: {url}")
+
+
+class ConcurrencyLimit:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = None
+        self.in_flight = 0
+        self.queued = 0
+
+    async def acquire(self, timeout: float) -> bool:
+        if self.semaphore is None:
+            # Lazily, inside the worker's event loop
+            self.semaphore = asyncio.Semaphore(self.limit)
+        if self.semaphore.locked():
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.queued -= 1
+        else:
+            await self.semaphore.acquire()
+        self.in_flight += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+
+backend = backend_from_url(ADMISSION_BACKEND_URL)
+limits = {name: ConcurrencyLimit(route_class.concurrency) for name, route_class in CLASSES.items() if route_class.concurrency}
+_counters = defaultdict(Counter)  # class -> counter -> value
+_backend_errors = 0
+
+
+async def _take(key: str, rate: float, burst: int) -> float:
+    global _backend_errors
+    if not rate:
+        return 0.0
+    try:
+        return await backend.take(key, rate, burst)
+    except Exception:
+        _backend_errors += 1
+        logger.exception("admission: cannot reach the bucket backend, admitting the request")
+        return 0.0
+
+
+def user_key(request: Request):
+    """Bucket key of the user behind the request, None when it carries no credentials."""
+    scheme, _, token = request.headers.get("authorization", "").partition(" ")
+    token = token if scheme.lower() == "bearer" else request.query_params.get("access_token")
+    if token:
+        # Every token issued to one user shares the bucket; only verified tokens count
+        try:
+            subject = jwt.decode(token, auth.SECRET_KEY, algorithms=[auth.ALGORITHM]).get("sub")
+        except JWTError:
+            subject = None
+        if subject:
+            return f"sub:{subject}"
+    return database.client_key(request)
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware, so rejected uploads are never read."""
+
+    def __init__(self, app, routes):
+        self.app = app
+        self.routes = [
+            (route, ROUTE_CLASSES[method, route.path])
+            for route in routes
+            for method in getattr(route, "methods", None) or ()
+            if (method, getattr(route, "path", None)) in ROUTE_CLASSES
+        ]
+
+    def _match(self, scope):
+        for route, name in self.routes:
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return route, name
+        return None, None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ADMISSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        route, name = self._match(scope)
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+
+        route_class, counters = CLASSES[name], _counters[name]
+        client = scope.get("client")
+        wait = await _take(f"{name}:ip:{client[0] if client else 'unknown'}", route_class.ip_rate, route_class.ip_burst)
+        user = user_key(Request(scope))
+        if not wait and user is not None:
+            wait = await _take(f"{name}:user:{user}", route_class.user_rate, route_class.user_burst)
+        if wait:
+            counters["rate_limited_total"] += 1
+            await self._reject(scope, receive, send, route, 429, "Too many requests, please retry later", wait)
+            return
+
+        limit = limits.get(name)
+        if limit is None:
+            counters["admitted_total"] += 1
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        admitted = await limit.acquire(ADMISSION_QUEUE_SECONDS)
+        counters["queue_seconds_total"] += time.perf_counter() - start
+        if not admitted:
+            counters["queue_timeouts_total"] += 1
+            await self._reject(scope, receive, send, route, 503, "Server is busy, please retry shortly", ADMISSION_QUEUE_SECONDS)
+            return
+        counters["admitted_total"] += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
+
+    async def _reject(self, scope, receive, send, route, status, detail, retry_after):
+        # The router never runs for a rejected request: label it with its route for the metrics
+        scope["route"] = route
+        response = JSONResponse(
+            {"detail": detail}, status_code=status, headers={"Retry-After": str(max(1, math.ceil(retry_after)))}
+        )
+        await response(scope, receive, send)
+
+
+def stats():
+    classes = {}
+    for name, route_class in CLASSES.items():
+        limit = limits.get(name)
+        classes[name] = {
+            **route_class._asdict(),
+            "in_flight": limit.in_flight if limit else 0,
+            "queued": limit.queued if limit else 0,
+            "admitted_total": _counters[name]["admitted_total"],
+            "rate_limited_total": _counters[name]["rate_limited_total"],
+            "queue_timeouts_total": _counters[name]["queue_timeouts_total"],
+            "queue_seconds_total": round(_counters[name]["queue_seconds_total"], 6),
+        }
+    return {
+        "enabled": int(ADMISSION_ENABLED),
+        "queue_seconds": ADMISSION_QUEUE_SECONDS,
+        "backend_errors": _backend_errors,
+        "buckets": backend.stats(),
+        **classes,
+    }
@@ -1,30 +1,78 @@
-from passlib.context import CryptContext
+import os
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 # auth.py
-from fastapi import Depends, HTTPException
+from typing import Optional
+from fastapi import Depends, HTTPException, Query
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from models import User
-from database import get_db
+from database import get_db, new_session
+from cache import TTLCache
+import hashing
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
 # Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = hashing.pwd_context
 
 # JWT settings
 SECRET_KEY = "your-secret-key"  # Replace with a secure secret key
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Hash password
-def hash_password(password: str) -> str:
-    return pwd_context.hash(password)
+# Authenticated user cache, keyed by the token subject (the user's email)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", 60))
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL_SECONDS)
+
+# Display names served by /users/names and /user/{userID}, keyed by user id
+USER_NAME_CACHE_SIZE = int(os.getenv("USER_NAME_CACHE_SIZE", 50000))
+USER_NAME_CACHE_TTL_SECONDS = float(os.getenv("USER_NAME_CACHE_TTL_SECONDS", 600))
+name_cache = TTLCache(maxsize=USER_NAME_CACHE_SIZE, ttl=USER_NAME_CACHE_TTL_SECONDS)
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    """Detached copy of the User columns the routes read; safe to share across sessions."""
+    id: int
+    email: str
+    firstname: str
+    lastname: str
+    role: str
+
+    @classmethod
+    def from_user(cls, user: User) -> "UserSnapshot":
+        return cls(
+            id=user.id,
+            email=user.email,
+            firstname=user.firstname,
+            lastname=user.lastname,
+            role=user.role,
+        )
+
+
+# Must be called whenever a user row changes so stale snapshots are not served
+def invalidate_user(email: str, user_id: int = None):
+    user_cache.pop(email)
+    if user_id is not None:
+        name_cache.pop(user_id)
+
+# Hash password (runs on the hashing pool, never on the request worker)
+async def hash_password(password: str) -> str:
+    return await hashing.hash_password(password)
 
 # Verify password
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    valid, _ = await hashing.verify_and_update(plain_password, hashed_password)
+    return valid
+
+# Verify password and return a fresh hash when pwd_context.needs_update says so
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    return await hashing.verify_and_update(plain_password, hashed_password)
 
 # Create JWT token
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -38,16 +86,41 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
+    return await user_from_token(token, db)
+
+# For plain links (file downloads, event streams) that cannot set an Authorization header
+async def get_current_user_from_header_or_query(
+    token: Optional[str] = Depends(optional_oauth2_scheme),
+    access_token: Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_db),
+):
+    token = token or access_token
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return await user_from_token(token, db)
+
+async def user_from_token(token: str, db: AsyncSession):
     try:
         # Decode the JWT token
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
         if email is None:
             raise HTTPException(status_code=401, detail="Invalid token")
-        user = db.query(User).filter(User.email == email).first()
+        user = user_cache.get(email)
         if user is None:
-            raise HTTPException(status_code=401, detail="User not found")
+            db_user = await db.scalar(select(User).where(User.email == email))
+            if db_user is None and db.info.get("replica"):
+                # A user who has just registered may not have reached the replica yet
+                primary = new_session()
+                try:
+                    db_user = await primary.scalar(select(User).where(User.email == email))
+                finally:
+                    await primary.close()
+            if db_user is None:
+                raise HTTPException(status_code=401, detail="User not found")
+            user = UserSnapshot.from_user(db_user)
+            user_cache.set(email, user)
         return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token has expired")
@@ -0,0 +1,201 @@
+"""Content-addressed storage for attachments and submissions.
+
+Every uploaded file is stored once under files/blobs/<aa>/<sha256>, however
+many submissions or assessments refer to it. The rows keep their
+human-facing path (Submission.file_path, Assessment.attachment) and point at
+the content through file_hash / attachment_hash. Maintenance commands:
+
+    python blobstore.py gc [--recount]
+"""
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import time
+from uuid import uuid4
+
+from sqlalchemy import select, update, delete, func
+from starlette.concurrency import run_in_threadpool
+
+import database
+import models
+import uploads
+
+BLOB_DIR = os.path.join("files", "blobs")
+INCOMING_DIR = os.path.join(BLOB_DIR, "incoming")
+# Files younger than this are never collected, so an upload that is about to
+# reference a blob cannot lose it to a concurrent gc run
+ORPHAN_GRACE_SECONDS = 3600
+
+logger = logging.getLogger("blobstore")
+
+# (model, human-facing path column, hash column) for everything that references blobs
+REFERENCES = [
+    (models.Submission, models.Submission.file_path, models.Submission.file_hash),
+    (models.Assessment, models.Assessment.attachment, models.Assessment.attachment_hash),
+]
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(BLOB_DIR, sha256[:2], sha256)
+
+
+def _place(temp_path, sha256):
+    path = blob_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        # Same content is already stored: keep the existing copy and mark it as freshly used
+        os.remove(temp_path)
+        os.utime(path)
+    else:
+        os.replace(temp_path, path)
+    return path
+
+
+async def store_upload(upload, max_bytes: int = uploads.MAX_UPLOAD_BYTES) -> uploads.StoredUpload:
+    stored = await uploads.save_upload(upload, INCOMING_DIR, uuid4().hex, max_bytes)
+    path = await run_in_threadpool(_place, stored.path, stored.sha256)
+    return stored._replace(path=path)
+
+
+def _increment_statement(dialect_name):
+    return database.upsert_increment(dialect_name, models.Blob.__table__, ["sha256"], ["refcount"])
+
+
+async def add_reference(db, stored: uploads.StoredUpload):
+    """Count one more row pointing at the blob; runs in the caller's transaction."""
+    await db.execute(
+        _increment_statement(db.get_bind().dialect.name),
+        [{"sha256": stored.sha256, "size": stored.size, "refcount": 1}],
+    )
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(uploads.CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _link_or_copy(path, temp_path):
+    try:
+        os.link(path, temp_path)
+    except OSError:
+        # Another filesystem, or one without hard links
+        shutil.copy2(path, temp_path)
+
+
+def import_legacy_files(conn):
+    """Add files saved under their human-facing path to the blob store.
+
+    The originals stay in place until the transaction has committed; the
+    returned callable removes them and is run by migrate.py afterwards.
+    """
+    imported = {}
+    for model, path_column, hash_column in REFERENCES:
+        rows = conn.execute(
+            select(model.id, path_column).where(path_column.is_not(None), hash_column.is_(None))
+        ).all()
+        for row_id, path in rows:
+            if path not in imported:
+                if not os.path.isfile(path):
+                    logger.warning("%s %s: %s is missing, left as is", model.__tablename__, row_id, path)
+                    continue
+                sha256, size = _hash_file(path)
+                temp_path = os.path.join(INCOMING_DIR, uuid4().hex)
+                os.makedirs(INCOMING_DIR, exist_ok=True)
+                _link_or_copy(path, temp_path)
+                # A fresh mtime keeps a concurrent gc off the blob until its row commits
+                os.utime(_place(temp_path, sha256))
+                imported[path] = (sha256, size)
+            sha256, size = imported[path]
+            conn.execute(update(model).where(model.id == row_id).values({hash_column.key: sha256}))
+            conn.execute(_increment_statement(conn.dialect.name), [{"sha256": sha256, "size": size, "refcount": 1}])
+    if imported:
+        logger.info("blobs: imported %d file(s) into %s", len(imported), BLOB_DIR)
+
+    def remove_originals():
+        for path in imported:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    return remove_originals
+
+
+def recount(conn):
+    # Rebuild every refcount from the referencing rows
+    total = None
+    for model, _, hash_column in REFERENCES:
+        count = (
+            select(func.count())
+            .select_from(model)
+            .where(hash_column == models.Blob.sha256)
+            .scalar_subquery()
+        )
+        total = count if total is None else total + count
+    conn.execute(update(models.Blob).values(refcount=total))
+
+
+def _is_old(path, now):
+    try:
+        return now - os.path.getmtime(path) > ORPHAN_GRACE_SECONDS
+    except FileNotFoundError:
+        return False
+
+
+def gc(engine, recount_first: bool = False):
+    """Delete unreferenced blobs and any stored file without a blobs row."""
+    now = time.time()
+    doomed = []
+    with engine.begin() as conn:
+        if recount_first:
+            recount(conn)
+        unreferenced = conn.execute(
+            select(models.Blob.sha256).where(models.Blob.refcount <= 0)
+        ).scalars().all()
+        for sha256 in unreferenced:
+            path = blob_path(sha256)
+            if os.path.exists(path) and not _is_old(path, now):
+                continue
+            deleted = conn.execute(
+                delete(models.Blob).where(models.Blob.sha256 == sha256, models.Blob.refcount <= 0)
+            ).rowcount
+            if deleted:
+                doomed.append(path)
+
+        # Files left behind by uploads whose transaction never committed
+        known = set(conn.execute(select(models.Blob.sha256)).scalars())
+        for directory, _, filenames in os.walk(BLOB_DIR):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                if filename not in known and _is_old(path, now):
+                    doomed.append(path)
+
+    # Only unlink once the rows are gone, and skip anything an upload reused meanwhile
+    removed = 0
+    for path in doomed:
+        if _is_old(path, time.time()):
+            os.remove(path)
+            removed += 1
+    logger.info("blobs: removed %d unreferenced file(s)", removed)
+    return removed
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    gc_parser = commands.add_parser("gc", help="delete blobs that nothing references")
+    gc_parser.add_argument("--recount", action="store_true", help="rebuild refcounts from the referencing rows first")
+    args = parser.parse_args()
+
+    if args.command == "gc":
+        gc(engine, recount_first=args.recount)
@@ -0,0 +1,191 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+from uuid import uuid4
+
+logger = logging.getLogger("cache")
+
+
+class TTLCache:
+    """Bounded LRU mapping whose entries also expire after a time-to-live."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[0] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class LocalBackend:
+    """Response cache storage in this process only, on top of TTLCache."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.entries = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.entries.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        self.entries.set(key, value, ttl)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class RedisBackend:
+    """Response cache storage shared by every worker through Redis."""
+
+    def __init__(self, url: str, ttl: float, prefix: str = "devclassroom:"):
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("A redis:// cache URL needs the redis package (pip install redis)") from e
+        self.client = redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes, ttl: float = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        await self.client.set(self.prefix + key, value, px=int(ttl * 1000))
+
+    def stats(self):
+        return {"backend": "redis", "ttl_seconds": self.ttl}
+
+
+def backend_from_url(url: str, maxsize: int, ttl: float):
+    if not url or url == "local":
+        return LocalBackend(maxsize, ttl)
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url, ttl)
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+
+class CachedResponse(NamedTuple):
+    etag: str
+    body: bytes
+
+
+class ResponseCache:
+    """Serialized responses tagged with the version of the scope they were read from.
+
+    Every scope (e.g. one subject) has a version token that writers replace
+    with bump(). An entry is only served while the token it was stored with is
+    still current, so one bump invalidates everything under the scope, in
+    every worker sharing the backend. Readers must take the version before
+    querying the database: a response built from data older than a bump is
+    then stored under the old token and never served.
+    """
+
+    def __init__(self, backend, ttl: float):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    async def version(self, scope: str) -> Optional[str]:
+        try:
+            version = await self.backend.get(f"version:{scope}")
+            if version is None:
+                # Unknown or evicted: start a new version, which also retires any entry of the old one
+                version = uuid4().hex.encode()
+                await self.backend.set(f"version:{scope}", version)
+            return version.decode() if isinstance(version, bytes) else version
+        except Exception:
+            self.errors += 1
+            logger.exception("response cache: cannot read the version of %s", scope)
+            return None
+
+    async def bump(self, scope: str):
+        try:
+            await self.backend.set(f"version:{scope}", uuid4().hex.encode())
+        except Exception:
+            # Entries of this scope stay served until they expire
+            self.errors += 1
+            logger.exception("response cache: cannot invalidate %s", scope)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        try:
+            entry = await self.backend.get(key)
+            if entry is not None:
+                scope, version, etag, body = entry.split(b"\n", 3)
+                if version.decode() == await self.version(scope.decode()):
+                    self.hits += 1
+                    return CachedResponse(etag.decode(), body)
+        except Exception:
+            self.errors += 1
+            logger.exception("response cache: cannot read %s", key)
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, scope: str, version: Optional[str], response: CachedResponse):
+        if version is None:
+            return
+        entry = b"\n".join([scope.encode(), version.encode(), response.etag.encode(), response.body])
+        try:
+            await self.backend.set(key, entry, self.ttl)
+        except Exception:
+            self.errors += 1
+            logger.exception("response cache: cannot store %s", key)
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "backend": self.backend.stats(),
+        }
@@ -0,0 +1,251 @@
+"""Server-sent events for submissions, grades and new assessments.
+
+Routes publish to channels after committing: "subject:{id}" carries every
+event of a subject for its teacher, "student:{id}" a student's own
+submissions and grades. Each worker runs a Broker that fans events out to
+its connected clients; the backend decides how events reach the other
+workers:
+
+- local (default): this process only, enough for a single worker.
+- unix:///path/to/dir: every worker binds a datagram socket in the directory
+  and publishing sends to all of them, so workers on one host share events
+  without extra infrastructure.
+
+Delivery is best effort: events missed while disconnected are not replayed,
+clients catch up through the regular endpoints (e.g. /student/dashboard)
+after reconnecting.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import threading
+from uuid import uuid4
+
+logger = logging.getLogger("events")
+
+# Event settings
+EVENTS_BACKEND_URL = os.getenv("EVENTS_BACKEND_URL", "")
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", 100))
+KEEPALIVE_SECONDS = 15
+MAX_DATAGRAM_BYTES = 64 * 1024
+
+
+class LocalBackend:
+    """Delivers to this process only."""
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, message: bytes):
+        self.deliver(message)
+
+    def close(self):
+        pass
+
+
+class UnixSocketBackend:
+    """Fans events out to every worker with a socket in a shared directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.sock = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid4().hex[:8]}.sock")
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._receive)
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.sock.recv(MAX_DATAGRAM_BYTES)
+            except BlockingIOError:
+                return
+            self.deliver(message)
+
+    def publish(self, message: bytes):
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                self.sock.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                # Socket left behind by a worker that is gone
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            except BlockingIOError:
+                logger.warning("events: dropped an event for %s, its receive buffer is full", name)
+
+    def close(self):
+        if self.sock is not None:
+            asyncio.get_running_loop().remove_reader(self.sock.fileno())
+            self.sock.close()
+            os.remove(self.path)
+            self.sock = None
+
+
+def backend_from_url(url: str):
+    if not url or url == "local":
+        return LocalBackend()
+    if url.startswith("unix://"):
+        return UnixSocketBackend(url[len("unix://"):])
+    raise ValueError(f"Unsupported events backend URL: {url}")
+
+
+class Subscription:
+    def __init__(self, broker, channels):
+        self.broker = broker
+        self.channels = set(channels)
+        self.queue = asyncio.Queue(EVENTS_QUEUE_SIZE)
+        self.ended = False
+
+    def __enter__(self):
+        self.broker.add(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.broker.remove(self)
+
+    def end(self):
+        # Makes the stream return; a full queue gives up its oldest frame for the marker
+        if not self.ended:
+            self.ended = True
+            if self.queue.full():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class Broker:
+    def __init__(self, backend):
+        self.backend = backend
+        self.started = False
+        self.subscriptions = {}  # channel -> set of Subscription
+        self.ids = itertools.count(1)
+        self.published = 0
+        self.delivered = 0
+        self.dropped = 0
+
+    def _start(self):
+        # Lazily, from inside the worker's event loop (after any fork)
+        if not self.started:
+            self.backend.start(self._deliver)
+            self.started = True
+
+    def subscribe(self, channels) -> Subscription:
+        self._start()
+        return Subscription(self, channels)
+
+    def add(self, subscription):
+        for channel in subscription.channels:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+
+    def remove(self, subscription):
+        for channel in subscription.channels:
+            subscribers = self.subscriptions.get(channel)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscriptions[channel]
+
+    def publish(self, channels, event: str, data: dict):
+        """Send event to channels in every worker; never raises into the calling route."""
+        message = json.dumps({"channels": list(channels), "event": event, "data": data}).encode("utf-8")
+        try:
+            self._start()
+            self.backend.publish(message)
+            self.published += 1
+        except Exception:
+            logger.exception("events: cannot publish %s", event)
+
+    def _deliver(self, message: bytes):
+        try:
+            decoded = json.loads(message)
+        except ValueError:
+            logger.warning("events: ignored a malformed message")
+            return
+        # A client subscribed to several of the channels gets the event once
+        targets = set()
+        for channel in decoded["channels"]:
+            targets.update(self.subscriptions.get(channel, ()))
+        if not targets:
+            return
+        frame = f"id: {next(self.ids)}\nevent: {decoded['event']}\ndata: {json.dumps(decoded['data'])}\n\n"
+        for subscription in targets:
+            if subscription.ended:
+                continue
+            try:
+                subscription.queue.put_nowait(frame)
+                self.delivered += 1
+            except asyncio.QueueFull:
+                # Too slow to keep up: end its stream, the client reconnects and resyncs
+                self.dropped += 1
+                subscription.end()
+
+    def drain(self):
+        """End every open stream, e.g. when the worker shuts down; clients reconnect elsewhere."""
+        for subscription in {s for subscribers in self.subscriptions.values() for s in subscribers}:
+            subscription.end()
+
+    def close(self):
+        if self.started:
+            self.backend.close()
+            self.started = False
+
+    def stats(self):
+        return {
+            "backend": type(self.backend).__name__,
+            "subscriptions": len({s for subscribers in self.subscriptions.values() for s in subscribers}),
+            "channels": len(self.subscriptions),
+            "published": self.published,
+            "delivered": self.delivered,
+            "dropped_subscriptions": self.dropped,
+        }
+
+
+broker = Broker(backend_from_url(EVENTS_BACKEND_URL))
+
+
+def drain_on_exit_signals():
+    """End the streams as soon as SIGINT/SIGTERM arrives, from inside the worker's event loop.
+
+    uvicorn only runs the shutdown once every response is complete, which an
+    event stream never is. Chains to the handlers the server installed, so
+    call it after they are in place (e.g. from the lifespan startup).
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        previous = signal.getsignal(signum)
+
+        def handler(signum, frame, previous=previous):
+            loop.call_soon_threadsafe(broker.drain)
+            if callable(previous):
+                previous(signum, frame)
+
+        signal.signal(signum, handler)
+
+
+async def sse_stream(channels):
+    """text/event-stream body for a client subscribed to channels, until it disconnects."""
+    with broker.subscribe(channels) as subscription:
+        yield f"retry: 5000\nevent: ready\ndata: {json.dumps({'channels': sorted(channels)})}\n\n"
+        while True:
+            try:
+                frame = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+            except asyncio.TimeoutError:
+                # Comment line: keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            if frame is None:
+                return
+            yield frame
@@ -0,0 +1,142 @@
+"""Streaming CSV / XLSX / ZIP writers.
+
+Each produces the file as an iterator of byte chunks, so a StreamingResponse
+can send a large export piece by piece without ever holding it in memory or
+on disk. XLSX files are written directly as a zip of SpreadsheetML parts.
+"""
+import csv
+import io
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+from starlette.concurrency import run_in_threadpool
+
+ZIP_READ_CHUNK = 256 * 1024
+
+
+class Sink(io.RawIOBase):
+    """Write-only file object that hands back whatever was written since the last drain.
+
+    zipfile detects that it cannot seek and falls back to streaming mode
+    (local headers followed by data descriptors), which is what lets us send
+    an archive while it is being built.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+async def csv_stream(header, rows):
+    """Yield CSV bytes for header plus every row of the async iterable rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    async for row in rows:
+        writer.writerow(row)
+        if buffer.tell() >= 64 * 1024:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+
+_SHEET_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>"""
+
+_SHEET_END = "</sheetData></worksheet>"
+
+# Control characters are not allowed in XML 1.0 documents
+_INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+
+def _xlsx_row(values) -> str:
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append("<c/>")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            text = escape(_INVALID_XML.sub("", str(value)))
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+async def xlsx_stream(header, rows, sheet_name: str = "Sheet1"):
+    """Yield a single-sheet XLSX workbook for header plus every row of rows."""
+    sink = Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        archive.writestr("_rels/.rels", _ROOT_RELS)
+        sheet_name = re.sub(r"[\[\]:*?/\\]", " ", sheet_name)[:31] or "Sheet1"
+        archive.writestr("xl/workbook.xml", _WORKBOOK.format(name=escape(sheet_name, {'"': "&quot;"})))
+        archive.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        with archive.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as sheet:
+            sheet.write((_SHEET_START + _xlsx_row(header)).encode("utf-8"))
+            async for row in rows:
+                sheet.write(_xlsx_row(row).encode("utf-8"))
+                if chunk := sink.drain():
+                    yield chunk
+            sheet.write(_SHEET_END.encode("utf-8"))
+    yield sink.drain()
+
+
+async def zip_stream(entries):
+    """Yield a ZIP archive of entries, an async iterable of (name, source).
+
+    source is either bytes (stored compressed) or the path of a file on disk,
+    which is copied in chunks and stored as is since uploads are mostly
+    already-compressed formats.
+    """
+    sink = Sink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        async for name, source in entries:
+            if isinstance(source, bytes):
+                archive.writestr(name, source, compress_type=zipfile.ZIP_DEFLATED)
+            else:
+                source_file = await run_in_threadpool(open, source, "rb")
+                try:
+                    with archive.open(name, "w", force_zip64=True) as entry:
+                        while chunk := await run_in_threadpool(source_file.read, ZIP_READ_CHUNK):
+                            entry.write(chunk)
+                            yield sink.drain()
+                finally:
+                    await run_in_threadpool(source_file.close)
+            yield sink.drain()
+    yield sink.drain()
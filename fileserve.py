@@ -0,0 +1,147 @@
+import mimetypes
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import NamedTuple, Optional
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.responses import FileResponse, Response
+from sqlalchemy import select, exists
+from starlette.concurrency import run_in_threadpool
+
+import models
+import blobstore
+
+# Stored files never change under a given path, so clients may reuse them for
+# this long and revalidate with the ETag afterwards
+FILE_CACHE_MAX_AGE = int(os.getenv("FILE_CACHE_MAX_AGE", 3600))
+# Leave the body to a proxy in front of the app once the route has checked access:
+# "X-Accel-Redirect" for nginx (an internal location serving the files directory
+# at FILE_ACCEL_PREFIX) or "X-Sendfile" for Apache mod_xsendfile and lighttpd.
+# Off by default, since without such a proxy the client would get an empty body
+FILE_OFFLOAD_HEADER = os.getenv("FILE_OFFLOAD_HEADER", "")
+FILE_ACCEL_PREFIX = os.getenv("FILE_ACCEL_PREFIX", "/protected-files/")
+FILES_DIR = "files"
+
+
+class StoredFile(NamedTuple):
+    path: str  # Human-facing path, e.g. "files/students/1_2_report.pdf"
+    sha256: Optional[str]  # None for files uploaded before the blob store and not migrated yet
+    subject_id: int
+    creator_id: int
+    student_id: Optional[int]  # Set for submissions, None for assessment attachments
+
+
+async def find_stored_file(db, path: str) -> Optional[StoredFile]:
+    submission = (
+        await db.execute(
+            select(models.Submission.file_hash, models.Subject.id, models.Subject.creator_id, models.Submission.student_id)
+            .join(models.Assessment, models.Assessment.id == models.Submission.assessment_id)
+            .join(models.Subject, models.Subject.id == models.Assessment.subject_id)
+            .where(models.Submission.file_path == path)
+            .limit(1)
+        )
+    ).first()
+    if submission:
+        return StoredFile(path, *submission)
+
+    attachment = (
+        await db.execute(
+            select(models.Assessment.attachment_hash, models.Subject.id, models.Subject.creator_id)
+            .join(models.Subject, models.Subject.id == models.Assessment.subject_id)
+            .where(models.Assessment.attachment == path)
+            .order_by(models.Assessment.id.desc())
+            .limit(1)
+        )
+    ).first()
+    if attachment:
+        return StoredFile(path, *attachment, None)
+    return None
+
+
+async def can_read(db, stored: StoredFile, user) -> bool:
+    # The subject's teacher sees everything in it; a submission is also visible to its author
+    # and an attachment to every enrolled student
+    if user.id == stored.creator_id:
+        return True
+    if stored.student_id is not None:
+        return user.id == stored.student_id
+    return await db.scalar(
+        select(
+            exists().where(
+                models.student_subject.c.subject_id == stored.subject_id,
+                models.student_subject.c.student_id == user.id,
+            )
+        )
+    )
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+
+def _not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    try:
+        return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+async def file_response(request: Request, stored: StoredFile) -> Response:
+    if stored.sha256:
+        disk_path = blobstore.blob_path(stored.sha256)
+    else:
+        disk_path = stored.path
+    try:
+        stat_result = await run_in_threadpool(os.stat, disk_path)
+    except FileNotFoundError:
+        return Response(status_code=404)
+
+    # Blobs are named by their SHA-256, which makes a strong validator for free
+    etag = f'"{stored.sha256}"' if stored.sha256 else f'"{int(stat_result.st_mtime)}-{stat_result.st_size}"'
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": f"private, max-age={FILE_CACHE_MAX_AGE}",
+    }
+
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110 13.2.2)
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif if_modified_since and _not_modified_since(if_modified_since, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    filename = os.path.basename(stored.path)
+    if FILE_OFFLOAD_HEADER:
+        return _offload_response(disk_path, filename, headers)
+
+    # FileResponse answers Range/If-Range requests and streams the file in chunks
+    # through the worker; uvicorn has no zero-copy send (http.response.pathsend), so
+    # FILE_OFFLOAD_HEADER is the way to keep large downloads off the event loop
+    return FileResponse(
+        disk_path,
+        stat_result=stat_result,
+        headers=headers,
+        filename=filename,
+        content_disposition_type="inline",
+    )
+
+
+def _offload_response(disk_path: str, filename: str, headers: dict) -> Response:
+    if FILE_OFFLOAD_HEADER.lower() == "x-accel-redirect":
+        relative = os.path.relpath(disk_path, FILES_DIR).replace(os.sep, "/")
+        target = FILE_ACCEL_PREFIX.rstrip("/") + "/" + quote(relative)
+    else:
+        target = os.path.abspath(disk_path)
+    quoted = quote(filename)
+    disposition = f"inline; filename*=utf-8''{quoted}" if quoted != filename else f'inline; filename="{filename}"'
+    return Response(
+        media_type=mimetypes.guess_type(filename)[0] or "application/octet-stream",
+        headers={**headers, "content-disposition": disposition, FILE_OFFLOAD_HEADER: target},
+    )
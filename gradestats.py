@@ -0,0 +1,171 @@
+"""Grade statistics per assessment, kept up to date by the writes themselves.
+
+AssessmentStats holds the submitted/graded counts and the score sum;
+AssessmentScoreCount holds how many graded submissions have each score,
+which is enough for the median, min/max and histogram. submit_assessment
+and the grading endpoints apply their deltas in the same transaction as the
+submission change, so reading the statistics never scans submissions.
+Backfill or repair with:
+
+    python gradestats.py rebuild
+"""
+import argparse
+import logging
+from collections import Counter, defaultdict
+
+from sqlalchemy import select, insert, delete, func
+
+import database
+import models
+
+logger = logging.getLogger("gradestats")
+
+HISTOGRAM_BUCKETS = 10
+
+
+def _stats_statement(dialect_name):
+    return database.upsert_increment(
+        dialect_name, models.AssessmentStats.__table__, ["assessment_id"], ["submitted", "graded", "score_sum"]
+    )
+
+
+def _frequency_statement(dialect_name):
+    return database.upsert_increment(
+        dialect_name, models.AssessmentScoreCount.__table__, ["assessment_id", "score"], ["frequency"]
+    )
+
+
+async def record_submission(db, assessment_id: int):
+    """Count a new, ungraded submission; runs in the caller's transaction."""
+    await db.execute(
+        _stats_statement(db.get_bind().dialect.name),
+        [{"assessment_id": assessment_id, "submitted": 1, "graded": 0, "score_sum": 0}],
+    )
+
+
+async def record_grades(db, changes):
+    """Apply score changes, an iterable of (assessment_id, old score, new score), in the caller's transaction.
+
+    The caller must have read the old scores with a row lock (SELECT ... FOR
+    UPDATE) so that concurrent grading of the same submission is counted once.
+    """
+    totals = defaultdict(lambda: [0, 0])  # assessment_id -> [graded, score_sum] deltas
+    frequencies = Counter()  # (assessment_id, score) -> delta
+    for assessment_id, old_score, new_score in changes:
+        if old_score == new_score:
+            continue
+        if old_score is not None:
+            totals[assessment_id][0] -= 1
+            totals[assessment_id][1] -= old_score
+            frequencies[assessment_id, old_score] -= 1
+        if new_score is not None:
+            totals[assessment_id][0] += 1
+            totals[assessment_id][1] += new_score
+            frequencies[assessment_id, new_score] += 1
+
+    dialect_name = db.get_bind().dialect.name
+    stats_rows = [
+        {"assessment_id": assessment_id, "submitted": 0, "graded": graded, "score_sum": score_sum}
+        for assessment_id, (graded, score_sum) in totals.items()
+        if graded or score_sum
+    ]
+    if stats_rows:
+        await db.execute(_stats_statement(dialect_name), stats_rows)
+    frequency_rows = [
+        {"assessment_id": assessment_id, "score": score, "frequency": delta}
+        for (assessment_id, score), delta in frequencies.items()
+        if delta
+    ]
+    if frequency_rows:
+        await db.execute(_frequency_statement(dialect_name), frequency_rows)
+
+
+def _median(frequencies, total):
+    # frequencies: (score, count) pairs in score order
+    middle = [(total - 1) // 2, total // 2]
+    values, seen = [], 0
+    for score, count in frequencies:
+        while middle and middle[0] < seen + count:
+            values.append(score)
+            middle.pop(0)
+        seen += count
+    return sum(values) / len(values)
+
+
+def summarize(assessment_id, over, enrolled, submitted, graded, score_sum, frequencies):
+    """Statistics payload from the stored totals and the (score, count) pairs in score order."""
+    frequencies = [(score, count) for score, count in frequencies if count > 0]
+    scored = sum(count for _, count in frequencies)
+    top = max(over or 100, frequencies[-1][0] if frequencies else 0)
+    width = top / HISTOGRAM_BUCKETS
+    histogram = [
+        {"low": round(i * width, 2), "high": round((i + 1) * width, 2), "count": 0}
+        for i in range(HISTOGRAM_BUCKETS)
+    ]
+    for score, count in frequencies:
+        # Buckets are [low, high); the last one also takes a perfect score
+        histogram[min(HISTOGRAM_BUCKETS - 1, max(0, int(score / width)))]["count"] += count
+
+    return {
+        "assessment_id": assessment_id,
+        "over": over,
+        "enrolled": enrolled,
+        "submitted": submitted,
+        "graded": graded,
+        "submission_rate": round(submitted / enrolled, 4) if enrolled else None,
+        "average": round(score_sum / graded, 2) if graded else None,
+        "median": _median(frequencies, scored) if scored else None,
+        "min": frequencies[0][0] if frequencies else None,
+        "max": frequencies[-1][0] if frequencies else None,
+        "histogram": histogram,
+    }
+
+
+def rebuild(conn):
+    """Recompute every statistics row from the submissions."""
+    conn.execute(delete(models.AssessmentScoreCount))
+    conn.execute(delete(models.AssessmentStats))
+    conn.execute(
+        insert(models.AssessmentStats).from_select(
+            ["assessment_id", "submitted", "graded", "score_sum"],
+            select(
+                models.Submission.assessment_id,
+                func.count(),
+                func.count(models.Submission.score),
+                func.coalesce(func.sum(models.Submission.score), 0),
+            )
+            .where(models.Submission.assessment_id.is_not(None))
+            .group_by(models.Submission.assessment_id),
+        )
+    )
+    conn.execute(
+        insert(models.AssessmentScoreCount).from_select(
+            ["assessment_id", "score", "frequency"],
+            select(models.Submission.assessment_id, models.Submission.score, func.count())
+            .where(models.Submission.assessment_id.is_not(None), models.Submission.score.is_not(None))
+            .group_by(models.Submission.assessment_id, models.Submission.score),
+        )
+    )
+    logger.info("gradestats: rebuilt statistics from the submissions")
+
+
+def backfill(conn):
+    # Migration: fill the tables once for databases that have submissions from before them
+    if conn.scalar(select(func.count()).select_from(models.AssessmentStats)):
+        return
+    if conn.scalar(select(func.count()).select_from(models.Submission)):
+        rebuild(conn)
+
+
+if __name__ == "__main__":
+    from database import engine
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("rebuild", help="recompute every statistics row from the submissions")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        with engine.begin() as conn:
+            rebuild(conn)
@@ -0,0 +1,150 @@
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import HTTPException
+from passlib.context import CryptContext
+
+# Password hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# Hashing service settings
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", os.cpu_count() or 1))
+HASH_QUEUE_LIMIT = int(os.getenv("HASH_QUEUE_LIMIT", HASH_WORKERS * 8))
+# "process" keeps bcrypt off the interpreter running the app, "thread" is the
+# fallback for platforms that cannot fork
+HASH_EXECUTOR = os.getenv("HASH_EXECUTOR", "process" if hasattr(os, "fork") else "thread")
+# By the time the pool starts the app is already running threads, and a fork
+# copies whatever lock one of them holds; the fork server forks the hashing
+# processes from a clean single-threaded process instead
+HASH_START_METHOD = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "fork"
+THROUGHPUT_WINDOW_SECONDS = 60
+
+_executor = None
+_executor_lock = threading.Lock()
+_in_flight = 0
+_completed = deque()
+_counters = {
+    "hash_total": 0,
+    "verify_total": 0,
+    "rehash_total": 0,
+    "rejected_total": 0,
+    "restarts_total": 0,
+    "busy_seconds_total": 0.0,
+}
+
+
+# These run inside the pool, so they must stay importable top-level functions
+def _hash(password):
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(password, hashed_password):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if HASH_EXECUTOR == "process":
+                context = multiprocessing.get_context(HASH_START_METHOD)
+                if HASH_START_METHOD == "forkserver":
+                    # Workers start with bcrypt already imported
+                    context.set_forkserver_preload(["hashing"])
+                _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS, mp_context=context)
+            else:
+                _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hashing")
+        return _executor
+
+
+def _discard_executor(broken):
+    global _executor
+    with _executor_lock:
+        # Another request may already have replaced it
+        if _executor is not broken:
+            return
+        _executor = None
+        _counters["restarts_total"] += 1
+    broken.shutdown(wait=False)
+
+
+def shutdown():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+            _executor = None
+
+
+def _busy():
+    return HTTPException(
+        status_code=503,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": "1"},
+    )
+
+
+async def _run(counter, fn, *args):
+    global _in_flight
+    # Fail fast instead of letting a login storm queue behind the pool
+    if _in_flight >= HASH_WORKERS + HASH_QUEUE_LIMIT:
+        _counters["rejected_total"] += 1
+        raise _busy()
+
+    _in_flight += 1
+    start = time.perf_counter()
+    try:
+        loop = asyncio.get_running_loop()
+        for _ in range(2):
+            executor = _get_executor()
+            try:
+                return await loop.run_in_executor(executor, fn, *args)
+            except BrokenProcessPool:
+                # A hashing process died (e.g. OOM killed): replace the pool and retry once
+                _discard_executor(executor)
+        _counters["rejected_total"] += 1
+        raise _busy()
+    finally:
+        _in_flight -= 1
+        now = time.perf_counter()
+        _counters[counter] += 1
+        _counters["busy_seconds_total"] += now - start
+        _completed.append(now)
+        _trim_completed(now)
+
+
+async def hash_password(password: str) -> str:
+    return await _run("hash_total", _hash, password)
+
+
+async def verify_and_update(password: str, hashed_password: str):
+    """Returns (valid, new_hash); new_hash is set when the stored hash is outdated."""
+    valid, new_hash = await _run("verify_total", _verify_and_update, password, hashed_password)
+    if new_hash is not None:
+        _counters["rehash_total"] += 1
+    return valid, new_hash
+
+
+def _trim_completed(now):
+    # Keep only the throughput window, whether or not stats() is ever read
+    while _completed and now - _completed[0] > THROUGHPUT_WINDOW_SECONDS:
+        _completed.popleft()
+
+
+def stats():
+    now = time.perf_counter()
+    _trim_completed(now)
+    return {
+        "executor": HASH_EXECUTOR,
+        "workers": HASH_WORKERS,
+        "queue_limit": HASH_QUEUE_LIMIT,
+        "in_flight": _in_flight,
+        "ops_per_second": round(len(_completed) / THROUGHPUT_WINDOW_SECONDS, 3),
+        **_counters,
+    }
@@ -0,0 +1,454 @@
+"""Synthetic classroom data and a load generator for benchmarking the API.
+
+    python loadtest.py seed [--students 1000 ...] [--recreate]
+    python loadtest.py run [--mix mixed] [--users 20] [--duration 30] [--url http://host:8000] [--output results.json]
+    python loadtest.py compare baseline.json results.json [--tolerance 0.2]
+
+seed fills the database named by LOADTEST_DATABASE_URL (a scratch SQLite
+file, ./loadtest.db, by default; MySQL optional) with bulk inserts and a fixed
+random seed, so two runs produce the same data. The app's DATABASE_URL is
+never used, and --recreate on anything but the default scratch file also
+needs --confirm-recreate. run drives a traffic mix in-process through the ASGI app, or
+against a running server with --url, and reports throughput, p50/p95/p99
+per endpoint and SQL queries per request (read from /metrics). compare
+exits non-zero when a result regressed against a baseline. The runner needs
+httpx (pip install httpx).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+logger = logging.getLogger("loadtest")
+
+EMAIL_DOMAIN = "loadtest.example"
+PASSWORD = "loadtest"
+INSERT_CHUNK = 5000
+# Seeding and the in-process runner use this instead of DATABASE_URL, so that
+# seed --recreate can never drop the app's tables by accident
+SCRATCH_DATABASE_URL = "sqlite:///./loadtest.db"
+LOADTEST_DATABASE_URL = os.getenv("LOADTEST_DATABASE_URL", SCRATCH_DATABASE_URL)
+
+# Scenario name -> (role, route template as labelled in /metrics)
+SCENARIOS = {
+    "login": ("student", "POST /login"),
+    "poll": ("student", "GET /submission/check/{assessment_id}"),
+    "view": ("teacher", "GET /submissions/view/{assessment_id}"),
+    "upload": ("student", "POST /submission/{assessment_id}"),
+}
+
+# Traffic mixes: scenario -> weight
+MIXES = {
+    "login": {"login": 1.0},
+    "polling": {"poll": 0.8, "view": 0.2},
+    "uploads": {"upload": 1.0},
+    "mixed": {"login": 0.05, "poll": 0.7, "view": 0.15, "upload": 0.1},
+}
+
+
+def email(role, number):
+    return f"{role}{number}@{EMAIL_DOMAIN}"
+
+
+# Seeding
+
+def _insert(conn, table, rows):
+    for start in range(0, len(rows), INSERT_CHUNK):
+        conn.execute(table.insert(), rows[start:start + INSERT_CHUNK])
+
+
+def seed(args):
+    from sqlalchemy import select, func
+    import database
+    import gradestats
+    import hashing
+    import models
+
+    rng = random.Random(args.seed)
+    engine = database.engine
+    if args.recreate:
+        database.Base.metadata.drop_all(bind=engine)
+    database.Base.metadata.create_all(bind=engine)
+
+    with engine.begin() as conn:
+        existing = conn.scalar(
+            select(func.count()).select_from(models.User).where(models.User.email.like(f"%@{EMAIL_DOMAIN}"))
+        )
+        if existing:
+            sys.exit(f"The database already holds {existing} load test users; pass --recreate to start over")
+
+        started = time.perf_counter()
+        # One bcrypt hash shared by every account: hashing each would take minutes
+        password = hashing.pwd_context.hash(PASSWORD)
+        users = [
+            {"email": email("teacher", n), "password": password, "firstname": f"Teacher{n}", "lastname": "Load", "role": "teacher"}
+            for n in range(args.teachers)
+        ] + [
+            {"email": email("student", n), "password": password, "firstname": f"Student{n}", "lastname": "Load", "role": "student"}
+            for n in range(args.students)
+        ]
+        _insert(conn, models.User.__table__, users)
+        ids = dict(conn.execute(
+            select(models.User.email, models.User.id).where(models.User.email.like(f"%@{EMAIL_DOMAIN}"))
+        ).all())
+        teacher_ids = [ids[email("teacher", n)] for n in range(args.teachers)]
+        student_ids = [ids[email("student", n)] for n in range(args.students)]
+
+        _insert(conn, models.Subject.__table__, [
+            {"name": f"Subject {n}", "code": f"LT{n:05d}", "creator_id": teacher_ids[n % len(teacher_ids)]}
+            for n in range(args.subjects)
+        ])
+        subject_ids = conn.execute(
+            select(models.Subject.id).where(models.Subject.code.like("LT%")).order_by(models.Subject.id)
+        ).scalars().all()
+
+        enrollments = []
+        per_student = min(args.subjects_per_student, len(subject_ids))
+        for student_id in student_ids:
+            for subject_id in rng.sample(subject_ids, per_student):
+                enrollments.append({"student_id": student_id, "subject_id": subject_id})
+        _insert(conn, models.student_subject, enrollments)
+
+        _insert(conn, models.Assessment.__table__, [
+            {"name": f"Assessment {n}", "description": "Load test assessment", "over": 100, "subject_id": subject_id}
+            for subject_id in subject_ids
+            for n in range(args.assessments_per_subject)
+        ])
+        assessments = defaultdict(list)
+        for assessment_id, subject_id in conn.execute(
+            select(models.Assessment.id, models.Assessment.subject_id).where(models.Assessment.subject_id.in_(subject_ids))
+        ):
+            assessments[subject_id].append(assessment_id)
+
+        submissions = []
+        for enrollment in enrollments:
+            for assessment_id in assessments[enrollment["subject_id"]]:
+                if rng.random() < args.submission_rate:
+                    graded = rng.random() < 0.5
+                    submissions.append({
+                        "assessment_id": assessment_id,
+                        "student_id": enrollment["student_id"],
+                        "file_path": f"files/students/{assessment_id}_{enrollment['student_id']}_seed.txt",
+                        "score": rng.randint(0, 100) if graded else None,
+                        "feedback": "Seeded" if graded else None,
+                    })
+        _insert(conn, models.Submission.__table__, submissions)
+        gradestats.rebuild(conn)
+
+    logger.info(
+        "seeded %d teachers, %d students, %d subjects, %d enrollments, %d assessments, %d submissions in %.1f s",
+        len(teacher_ids), len(student_ids), len(subject_ids), len(enrollments),
+        sum(len(ids) for ids in assessments.values()), len(submissions), time.perf_counter() - started,
+    )
+
+
+# Traffic
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))]
+
+
+class VirtualUser:
+    """One client holding a student and a teacher session, picking actions from the mix."""
+
+    def __init__(self, number, client, args, rng):
+        self.client = client
+        self.args = args
+        self.rng = rng
+        self.student_email = email("student", number % args.students)
+        self.teacher_email = email("teacher", number % args.teachers)
+        self.headers = {}
+        self.assessments = {}
+        self.uploaded = set()
+
+    async def login(self, address):
+        # Setup logs every user in at once: back off when the hashing pool sheds load
+        while (response := await self.client.post("/login", json={"email": address, "password": PASSWORD})).status_code == 503:
+            await asyncio.sleep(float(response.headers.get("retry-after", 1)) * self.rng.random())
+        response.raise_for_status()
+        return {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    async def discover(self, role, summary_path):
+        # Find the assessments this identity can reach through the API, as a client would
+        headers = self.headers[role]
+        subjects, after_id = [], None
+        while True:
+            params = {"limit": 500} if after_id is None else {"limit": 500, "after_id": after_id}
+            page = (await self.client.get(summary_path, params=params, headers=headers)).json()
+            subjects += [subject["id"] for subject in page["items"]]
+            if not (after_id := page["next_after_id"]):
+                break
+        assessment_ids = []
+        for subject_id in subjects:
+            assessment_ids += [a["id"] for a in (await self.client.get(f"/assessments/{subject_id}")).json()]
+        return assessment_ids
+
+    async def setup(self):
+        self.headers["student"] = await self.login(self.student_email)
+        self.headers["teacher"] = await self.login(self.teacher_email)
+        self.assessments["student"] = await self.discover("student", "/student/subjects/summary")
+        self.assessments["teacher"] = await self.discover("teacher", "/teacher/subjects/summary")
+
+    async def act(self, scenario):
+        role = SCENARIOS[scenario][0]
+        if scenario == "login":
+            return await self.client.post("/login", json={"email": self.student_email, "password": PASSWORD})
+        if not self.assessments[role]:
+            return None
+        assessment_id = self.rng.choice(self.assessments[role])
+        if scenario == "poll":
+            return await self.client.get(f"/submission/check/{assessment_id}", headers=self.headers[role])
+        if scenario == "view":
+            return await self.client.get(
+                f"/submissions/view/{assessment_id}", params={"limit": 50}, headers=self.headers[role]
+            )
+        # Prefer assessments this user has not uploaded to yet; seeded submissions still answer 400
+        pending = [a for a in self.assessments[role] if a not in self.uploaded] or self.assessments[role]
+        assessment_id = self.rng.choice(pending)
+        self.uploaded.add(assessment_id)
+        files = {"file": ("loadtest.bin", os.urandom(self.args.upload_bytes), "application/octet-stream")}
+        return await self.client.post(f"/submission/{assessment_id}", files=files, headers=self.headers[role])
+
+
+_METRIC_LINE = re.compile(r'^http_request_db_queries_(sum|count)\{method="([^"]+)",route="([^"]+)"\} (\S+)$')
+
+
+async def query_totals(client):
+    # {"GET /route": [queries, requests]} from the server's own instrumentation
+    totals = defaultdict(lambda: [0.0, 0.0])
+    response = await client.get("/metrics")
+    if response.status_code != 200:
+        return totals
+    for line in response.text.splitlines():
+        if match := _METRIC_LINE.match(line):
+            kind, method, route, value = match.groups()
+            totals[f"{method} {route}"][0 if kind == "sum" else 1] = float(value)
+    return totals
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    import httpx
+
+    if args.url:
+        transport, base_url, target = None, args.url, args.url
+    else:
+        # Every virtual user shares one client address, which the per-address limits would throttle
+        os.environ.setdefault("ADMISSION_ENABLED", "0")
+        import main
+        transport, base_url, target = httpx.ASGITransport(app=main.app), "http://loadtest", "in-process"
+
+    mix = MIXES[args.mix]
+    scenarios, weights = list(mix), list(mix.values())
+    latencies = defaultdict(list)
+    statuses = defaultdict(Counter)
+    errors = Counter()
+
+    limits = httpx.Limits(max_connections=args.users)
+    async with httpx.AsyncClient(transport=transport, base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        users = [VirtualUser(n, client, args, random.Random(args.seed + n)) for n in range(args.users)]
+        logger.info("setting up %d virtual users against %s", len(users), target)
+        await asyncio.gather(*(user.setup() for user in users))
+        before = await query_totals(client)
+
+        started = time.perf_counter()
+        deadline = started + args.duration
+
+        async def drive(user):
+            while time.perf_counter() < deadline:
+                scenario = user.rng.choices(scenarios, weights)[0]
+                request_start = time.perf_counter()
+                try:
+                    response = await user.act(scenario)
+                except httpx.HTTPError as e:
+                    errors[scenario] += 1
+                    statuses[scenario][type(e).__name__] += 1
+                    continue
+                if response is None:
+                    continue
+                latencies[scenario].append(time.perf_counter() - request_start)
+                statuses[scenario][str(response.status_code)] += 1
+                if response.status_code >= 500:
+                    errors[scenario] += 1
+
+        logger.info("running the %s mix for %s s", args.mix, args.duration)
+        await asyncio.gather(*(drive(user) for user in users))
+        elapsed = time.perf_counter() - started
+        after = await query_totals(client)
+
+    endpoints = {}
+    for scenario in scenarios:
+        values = sorted(latencies[scenario])
+        route = SCENARIOS[scenario][1]
+        queries = after[route][0] - before[route][0]
+        requests = after[route][1] - before[route][1]
+        endpoints[scenario] = {
+            "route": route,
+            "requests": len(values),
+            "errors": errors[scenario],
+            "statuses": dict(statuses[scenario]),
+            "throughput_rps": round(len(values) / elapsed, 2),
+            "p50_ms": _ms(percentile(values, 50)),
+            "p95_ms": _ms(percentile(values, 95)),
+            "p99_ms": _ms(percentile(values, 99)),
+            "max_ms": _ms(values[-1] if values else None),
+            "queries_per_request": round(queries / requests, 2) if requests else None,
+        }
+    total = sum(endpoint["requests"] for endpoint in endpoints.values())
+    results = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "target": target,
+            "database": os.getenv("DATABASE_URL", "default").split(":", 1)[0],
+            "db_async": os.getenv("DB_ASYNC", "1") != "0",
+            "mix": args.mix,
+            "users": args.users,
+            "duration_seconds": round(elapsed, 3),
+            "seed": args.seed,
+        },
+        "total": {
+            "requests": total,
+            "errors": sum(errors.values()),
+            "throughput_rps": round(total / elapsed, 2),
+        },
+        "endpoints": endpoints,
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info("results written to %s", args.output)
+    return results
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def print_results(results):
+    print(f"{'endpoint':<8} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'queries':>8}")
+    for name, endpoint in results["endpoints"].items():
+        print(
+            f"{name:<8} {endpoint['requests']:>9} {endpoint['errors']:>7} {endpoint['throughput_rps']:>9} "
+            f"{_cell(endpoint['p50_ms'])} {_cell(endpoint['p95_ms'])} {_cell(endpoint['p99_ms'])} "
+            f"{_cell(endpoint['queries_per_request'], 8)}"
+        )
+    total = results["total"]
+    print(f"{'total':<8} {total['requests']:>9} {total['errors']:>7} {total['throughput_rps']:>9}")
+
+
+def _cell(value, width=9):
+    return f"{'-' if value is None else value:>{width}}"
+
+
+# Comparison
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.results) as f:
+        results = json.load(f)
+
+    regressions = []
+    for name, endpoint in results["endpoints"].items():
+        base = baseline["endpoints"].get(name)
+        if not base:
+            continue
+        checks = [
+            ("p95_ms", base["p95_ms"], endpoint["p95_ms"], lambda old, new: new > old * (1 + args.tolerance)),
+            ("throughput_rps", base["throughput_rps"], endpoint["throughput_rps"], lambda old, new: new < old * (1 - args.tolerance)),
+            ("queries_per_request", base["queries_per_request"], endpoint["queries_per_request"], lambda old, new: new > old),
+        ]
+        for metric, old, new, worse in checks:
+            if old is None or new is None:
+                continue
+            flag = worse(old, new)
+            print(f"{name:<8} {metric:<20} {old:>10} -> {new:<10}{'  REGRESSION' if flag else ''}")
+            if flag:
+                regressions.append(f"{name} {metric}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+def use_loadtest_database():
+    # Read by database.py on import, which has not happened yet
+    os.environ["DATABASE_URL"] = LOADTEST_DATABASE_URL
+    for name in ("ASYNC_DATABASE_URL", "DATABASE_REPLICA_URLS"):
+        os.environ.pop(name, None)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="fill the database with synthetic classroom data")
+    seed_parser.add_argument("--teachers", type=int, default=20)
+    seed_parser.add_argument("--students", type=int, default=1000)
+    seed_parser.add_argument("--subjects", type=int, default=40)
+    seed_parser.add_argument("--subjects-per-student", type=int, default=4)
+    seed_parser.add_argument("--assessments-per-subject", type=int, default=10)
+    seed_parser.add_argument("--submission-rate", type=float, default=0.5, help="share of (student, assessment) pairs already submitted")
+    seed_parser.add_argument("--seed", type=int, default=42)
+    seed_parser.add_argument("--recreate", action="store_true", help="drop and recreate every table first (destroys all data)")
+    seed_parser.add_argument("--confirm-recreate", action="store_true",
+                             help="allow --recreate on a LOADTEST_DATABASE_URL other than the scratch default")
+
+    run_parser = commands.add_parser("run", help="drive a traffic mix and report latencies")
+    run_parser.add_argument("--mix", choices=sorted(MIXES), default="mixed")
+    run_parser.add_argument("--users", type=int, default=20, help="concurrent virtual users")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds of traffic after setup")
+    run_parser.add_argument("--url", help="base URL of a running server; in-process when omitted")
+    run_parser.add_argument("--teachers", type=int, default=20, help="as seeded")
+    run_parser.add_argument("--students", type=int, default=1000, help="as seeded")
+    run_parser.add_argument("--upload-bytes", type=int, default=64 * 1024)
+    run_parser.add_argument("--timeout", type=float, default=30)
+    run_parser.add_argument("--seed", type=int, default=42)
+    run_parser.add_argument("--output", help="write the results as JSON to this file")
+
+    compare_parser = commands.add_parser("compare", help="check results against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("results")
+    compare_parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative p95 / throughput change")
+
+    args = parser.parse_args()
+    if args.command == "seed" or (args.command == "run" and not args.url):
+        use_loadtest_database()
+    if args.command == "seed":
+        if args.recreate and LOADTEST_DATABASE_URL != SCRATCH_DATABASE_URL and not args.confirm_recreate:
+            sys.exit(
+                f"--recreate drops every table of {LOADTEST_DATABASE_URL}, which is not the scratch database; "
+                "pass --confirm-recreate as well if that is intended"
+            )
+        seed(args)
+    elif args.command == "run":
+        asyncio.run(run(args))
+    elif args.command == "compare":
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
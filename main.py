@@ -1,48 +1,66 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Depends, Query, UploadFile, Body, Form
-from sqlalchemy.orm import Session
-from typing import List, Optional
+from fastapi import APIRouter, FastAPI, HTTPException, UploadFile, File, Depends, Query, UploadFile, Body, Form, Request
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Optional, Union
 from datetime import datetime
 import uvicorn
 from passlib.context import CryptContext
 from fastapi.security import OAuth2PasswordBearer
 import os
 from uuid import uuid4
-from sqlalchemy import desc
+from sqlalchemy import desc, select, exists, insert, update, or_, and_, func
+from sqlalchemy.exc import IntegrityError
 from typing import Dict, List
 from datetime import datetime
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from database import get_db, engine, Base
+from database import get_db, get_primary_db, new_session, engine, Base
 from models import (
     User,
     Subject,
 )
 import schemas
 from enum import Enum
-import models, schemas, auth
+import models, schemas, admission, auth, cache, database, events, gradestats, hashing, metrics, uploads, blobstore, fileserve, exports
 from auth import get_current_user
 from fastapi.middleware.cors import CORSMiddleware 
-import shutil
 import logging
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+import csv
+import hashlib
+from contextlib import asynccontextmanager
+import io
+import json
+import re
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 
-logging.basicConfig(level=logging.DEBUG)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
 class UserType(str, Enum):
     TEACHER = "teacher"
     STUDENT = "student"
 
+class GradeStatus(str, Enum):
+    GRADED = "graded"
+    UNGRADED = "ungraded"
+
+class ExportFormat(str, Enum):
+    CSV = "csv"
+    XLSX = "xlsx"
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-app = FastAPI(title="Appdev Classroom ", description="Google Classroom Clone")
+router = APIRouter()
+
+# Create missing tables when the app starts. serve.py does it once in the
+# parent process and sets CREATE_SCHEMA=0 for its workers
+CREATE_SCHEMA = os.getenv("CREATE_SCHEMA", "1") != "0"
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+def create_schema():
+    Base.metadata.create_all(bind=engine)
 
 UPLOAD_DIR = os.path.join(os.getcwd(), "files")
-app.mount("/files", StaticFiles(directory="files"), name="files")
 
 # Ensure the upload directory exists
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -56,60 +74,327 @@ origins = [
     "*",  # Allow all origins (not recommended for production)
 ]
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,  # Allows only these origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all HTTP methods
-    allow_headers=["*"],  # Allows all headers
-)
+for sync_engine in database.sync_engines():
+    metrics.instrument_engine(sync_engine)
 
 SECRET_KEY = "your_secret_key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Batch name lookups; names rarely change, so browsers may reuse them for USER_NAMES_MAX_AGE seconds
+USER_NAMES_MAX_IDS = 100
+USER_NAMES_MAX_AGE = int(os.getenv("USER_NAMES_MAX_AGE", 300))
+USER_NAMES_CACHE_CONTROL = f"public, max-age={USER_NAMES_MAX_AGE}"
+
+# Response cache for the assessment read endpoints. RESPONSE_CACHE_URL=redis://host:6379/0
+# shares it between workers; the default keeps a per-process LRU
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "")
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 10000))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", 300))
+response_cache = cache.ResponseCache(
+    cache.backend_from_url(RESPONSE_CACHE_URL, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL_SECONDS),
+    ttl=RESPONSE_CACHE_TTL_SECONDS,
+)
+
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # Helper Functions
 def get_password_hash(password: str):
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, email: str, password: str):
-    user = db.query(User).filter(User.email == email).first()
-    if user and auth.verify_password(password, user.password):  # Corrected line
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    user = await db.scalar(select(User).where(User.email == email))
+    if user and await auth.verify_password(password, user.password):  # Corrected line
         return user
     return None
 
-@app.get("/files/{filename}")
-async def serve_file(filename: str):
-    file_path = os.path.join(UPLOAD_DIR, filename)
-    logging.info(f"Attempting to serve file: {file_path}")
-    if os.path.exists(file_path):
-        return FileResponse(file_path)
-    else:
+async def is_enrolled(db: AsyncSession, subject_id: int, student_id: int) -> bool:
+    # Single-row EXISTS on the student_subject primary key, independent of roster size
+    return await db.scalar(
+        select(
+            exists().where(
+                models.student_subject.c.subject_id == subject_id,
+                models.student_subject.c.student_id == student_id,
+            )
+        )
+    )
+
+async def enroll_student(db: AsyncSession, subject_id: int, student_id: int):
+    try:
+        await db.execute(insert(models.student_subject).values(student_id=student_id, subject_id=subject_id))
+        await db.commit()
+    except IntegrityError:
+        # Lost a race with a concurrent enrollment of the same student
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="Student is already enrolled in this subject")
+
+BULK_ENROLL_LIMIT = 5000
+BULK_INSERT_CHUNK = 1000
+
+async def bulk_enroll(db: AsyncSession, subject_id: int, student_ids: List[int], emails: List[str]):
+    # Normalize once, keeping the caller's order and dropping repeated entries, so
+    # that the limit, the lookup and the result keys all see the same list
+    student_ids = list(dict.fromkeys(student_ids))
+    emails = list(dict.fromkeys(email.strip().lower() for email in emails if email.strip()))
+    keys = [str(student_id) for student_id in student_ids] + emails
+    if len(keys) > BULK_ENROLL_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_ENROLL_LIMIT} students can be enrolled at once")
+
+    # Resolve every id and email in one query
+    rows = (
+        await db.execute(
+            select(models.User.id, models.User.email).where(
+                models.User.role == "student",
+                # Stored emails keep the case they were registered with
+                or_(models.User.id.in_(student_ids), func.lower(models.User.email).in_(emails)),
+            )
+        )
+    ).all()
+    resolved = {}
+    for user_id, email in rows:
+        resolved[str(user_id)] = user_id
+        resolved[email.lower()] = user_id
+
+    for attempt in range(2):
+        found_ids = set(resolved.values())
+        enrolled_ids = set(
+            (
+                await db.scalars(
+                    select(models.student_subject.c.student_id).where(
+                        models.student_subject.c.subject_id == subject_id,
+                        models.student_subject.c.student_id.in_(found_ids),
+                    )
+                )
+            ).all()
+        )
+        new_ids = sorted(found_ids - enrolled_ids)
+        try:
+            # One multi-row INSERT per chunk, all in a single transaction
+            for start in range(0, len(new_ids), BULK_INSERT_CHUNK):
+                chunk = new_ids[start:start + BULK_INSERT_CHUNK]
+                await db.execute(
+                    insert(models.student_subject).values(
+                        [{"student_id": student_id, "subject_id": subject_id} for student_id in chunk]
+                    )
+                )
+            await db.commit()
+            break
+        except IntegrityError:
+            # Someone enrolled one of these students concurrently; recompute and retry once
+            await db.rollback()
+            if attempt:
+                raise HTTPException(status_code=409, detail="Enrollment changed concurrently, please retry")
+
+    results = []
+    for key in keys:
+        student_id = resolved.get(key)
+        if student_id is None:
+            status = "not_found"
+        elif student_id in enrolled_ids:
+            status = "already_enrolled"
+        else:
+            status = "added"
+            # The same student given by both id and email is added once
+            enrolled_ids.add(student_id)
+        results.append(schemas.EnrollmentResult(student=key, student_id=student_id, status=status))
+
+    return schemas.BulkEnrollmentOut(
+        subject_id=subject_id,
+        added=sum(result.status == "added" for result in results),
+        already_enrolled=sum(result.status == "already_enrolled" for result in results),
+        not_found=sum(result.status == "not_found" for result in results),
+        results=results,
+    )
+
+ROSTER_ID_COLUMNS = {"id", "student_id", "student id"}
+ROSTER_EMAIL_COLUMNS = {"email", "e-mail", "email address"}
+
+def parse_roster_csv(text: str):
+    """Student ids and emails from a roster CSV.
+
+    Either a header row naming an id and/or an email column (other columns, such
+    as names or sections, are ignored), or a single column of ids and emails
+    with an optional header. Anything else is rejected rather than guessed at,
+    since a stray number column would enroll whoever has those ids.
+    """
+    rows = [[cell.strip() for cell in row] for row in csv.reader(io.StringIO(text))]
+    rows = [(number, row) for number, row in enumerate(rows, 1) if any(row)]
+    if not rows:
+        return [], []
+
+    header = [cell.lower() for cell in rows[0][1]]
+    id_columns = [i for i, name in enumerate(header) if name in ROSTER_ID_COLUMNS]
+    email_columns = [i for i, name in enumerate(header) if name in ROSTER_EMAIL_COLUMNS]
+    if len(id_columns) > 1 or len(email_columns) > 1:
+        raise HTTPException(status_code=400, detail="Roster file has more than one id or email column")
+    single_column = not id_columns and not email_columns
+    if single_column and any(len(row) > 1 for _, row in rows):
+        raise HTTPException(
+            status_code=400,
+            detail="Roster file needs a header row with an id or email column, or a single column of ids and emails",
+        )
+
+    student_ids, emails = [], []
+    for index, (number, row) in enumerate(rows):
+        if single_column:
+            cell = row[0]
+            if cell.isdigit():
+                student_ids.append(int(cell))
+            elif "@" in cell:
+                emails.append(cell)
+            elif index:
+                raise HTTPException(status_code=400, detail=f"Row {number}: {cell!r} is neither a student id nor an email")
+            continue
+        if not index:
+            continue
+        for column in id_columns:
+            cell = row[column] if column < len(row) else ""
+            if cell and not cell.isdigit():
+                raise HTTPException(status_code=400, detail=f"Row {number}: {cell!r} is not a student id")
+            if cell:
+                student_ids.append(int(cell))
+        for column in email_columns:
+            cell = row[column] if column < len(row) else ""
+            if cell:
+                emails.append(cell)
+    return student_ids, emails
+
+async def get_owned_subject(db: AsyncSession, subject_id: int, teacher) -> models.Subject:
+    if teacher.role != "teacher":
+        raise HTTPException(status_code=403, detail="Only teachers can manage subjects")
+    subject = await db.scalar(select(models.Subject).where(models.Subject.id == subject_id))
+    if not subject:
+        raise HTTPException(status_code=404, detail="Subject not found")
+    if subject.creator_id != teacher.id:
+        raise HTTPException(status_code=403, detail="You are not the creator of this subject")
+    return subject
+
+@router.get("/files/{filename:path}")
+async def serve_file(
+    filename: str,
+    request: Request,
+    current_user: User = Depends(auth.get_current_user_from_header_or_query),
+    db: AsyncSession = Depends(get_db)
+):
+    # Stored paths look like "files/students/..."; the row tells where the content is and who may read it
+    stored = await fileserve.find_stored_file(db, f"files/{filename}")
+    if stored is None:
         raise HTTPException(status_code=404, detail="File not found")
+    if not await fileserve.can_read(db, stored, current_user):
+        raise HTTPException(status_code=403, detail="You do not have access to this file")
 
-@app.get("/users/details", response_model=schemas.UserOut)
-def get_me(current_user: User = Depends(get_current_user)):
-    return current_user
+    response = await fileserve.file_response(request, stored)
+    if response.status_code == 404:
+        raise HTTPException(status_code=404, detail="File not found")
+    return response
+
+@router.get("/metrics/hashing")
+async def hashing_metrics():
+    return hashing.stats()
+
+@router.get("/metrics/user-cache")
+async def user_cache_metrics():
+    return auth.user_cache.stats()
+
+@router.get("/metrics/admission")
+async def admission_metrics():
+    return admission.stats()
+
+@router.get("/metrics/db-pool")
+async def db_pool_metrics():
+    return database.pool_stats()
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    return metrics.render({
+        "hashing": hashing.stats(),
+        "admission": admission.stats(),
+        "user_cache": auth.user_cache.stats(),
+        "user_name_cache": auth.name_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "db_pool": database.pool_stats(),
+        "events": events.broker.stats(),
+    })
+
+# Server-sent events replacing the polling of /submission/check, /submission/student and
+# /submissions/view. EventSource cannot set headers, so the token may come as ?access_token=
+@router.get("/events")
+async def event_stream(
+    subject_id: List[int] = Query([]),  # Teachers: subjects to follow, all of their own when omitted
+    current_user: User = Depends(auth.get_current_user_from_header_or_query),
+    db: AsyncSession = Depends(get_db)
+):
+    if current_user.role == "teacher":
+        query = select(Subject.id).where(Subject.creator_id == current_user.id)
+        if subject_id:
+            query = query.where(Subject.id.in_(subject_id))
+        owned = (await db.scalars(query)).all()
+        if subject_id and len(owned) != len(set(subject_id)):
+            raise HTTPException(status_code=403, detail="You can only follow your own subjects")
+        channels = [f"subject:{owned_id}" for owned_id in owned]
+    elif current_user.role == "student":
+        channels = [f"student:{current_user.id}"]
+    else:
+        raise HTTPException(status_code=403, detail="Access denied")
 
-@app.get("/user/{userID}")
-def get_user_name(userID: str, db: Session = Depends(get_db)):
-    user = db.query(User).filter(User.id == userID).first()
+    # The stream stays open for as long as the client listens: give the connection back to the pool now
+    await db.close()
+    return StreamingResponse(
+        events.sse_stream(channels),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@router.get("/users/details", response_model=schemas.UserOut)
+async def get_me(current_user: User = Depends(get_current_user)):
+    return current_user
 
-    if user is None:
+async def user_names(db: AsyncSession, user_ids) -> dict:
+    """{id: {"firstName", "lastName"}} for the ids that exist, from the name cache and one IN query for the rest."""
+    names, missing = {}, []
+    for user_id in user_ids:
+        name = auth.name_cache.get(user_id)
+        if name is None:
+            missing.append(user_id)
+        else:
+            names[user_id] = name
+    if missing:
+        rows = await db.execute(select(User.id, User.firstname, User.lastname).where(User.id.in_(missing)))
+        for user_id, firstname, lastname in rows:
+            names[user_id] = {"firstName": firstname, "lastName": lastname}
+            auth.name_cache.set(user_id, names[user_id])
+    return names
+
+@router.get("/user/{userID}")
+async def get_user_name(userID: str, request: Request, db: AsyncSession = Depends(get_db)):
+    names = await user_names(db, [int(userID)]) if userID.isdigit() else {}
+    if not names:
         raise HTTPException(status_code=404, detail="User not found")
-    
-    return {"firstName": user.firstname, "lastName": user.lastname}
+    return cached_json_response(request, build_cached_response(names[int(userID)]), USER_NAMES_CACHE_CONTROL)
+
+# Names of several users in one request, for lists that would otherwise call /user/{userID} per row.
+# Unknown ids are left out of the response; sort the ids so that browsers can reuse cached responses
+@router.get("/users/names")
+async def get_user_names(
+    request: Request,
+    id: List[int] = Query(...),
+    db: AsyncSession = Depends(get_db),
+):
+    user_ids = list(dict.fromkeys(id))
+    if len(user_ids) > USER_NAMES_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {USER_NAMES_MAX_IDS} user ids per request")
+    names = await user_names(db, user_ids)
+    payload = {str(user_id): names[user_id] for user_id in user_ids if user_id in names}
+    return cached_json_response(request, build_cached_response(payload), USER_NAMES_CACHE_CONTROL)
 
 # Register user endpoint
-@app.post("/register", response_model=schemas.UserOut)
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
+@router.post("/register", response_model=schemas.UserOut)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = await db.scalar(select(models.User).where(models.User.email == user.email))
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_password = auth.hash_password(user.password)
+    hashed_password = await auth.hash_password(user.password)
     new_user = models.User(
         email=user.email,
         password=hashed_password,
@@ -118,30 +403,41 @@ def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         role = user.role,
     )
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    database.remember_writer(db, new_user.email)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 # Login user endpoint
-@app.post("/login")
-def login_user(user: schemas.UserLogin, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.email == user.email).first()
-    if not db_user or not auth.verify_password(user.password, db_user.password):
+@router.post("/login")
+async def login_user(user: schemas.UserLogin, db: AsyncSession = Depends(get_db)):
+    db_user = await db.scalar(select(models.User).where(models.User.email == user.email))
+    if not db_user:
         raise HTTPException(status_code=401, detail="Invalid credentials")
 
+    valid, new_hash = await auth.verify_and_update_password(user.password, db_user.password)
+    if not valid:
+        raise HTTPException(status_code=401, detail="Invalid credentials")
+
+    # Opportunistically upgrade hashes made with an outdated cost factor
+    if new_hash:
+        db_user.password = new_hash
+        await db.commit()
+        auth.invalidate_user(db_user.email, db_user.id)
+
     access_token = auth.create_access_token(data={"sub": db_user.email})
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.post("/subjects", response_model=schemas.SubjectCreate)
-def create_subject(
+@router.post("/subjects", response_model=schemas.SubjectCreate)
+async def create_subject(
     subject: schemas.SubjectCreate,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user) 
 ):
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can create subjects")
     
-    existing_subject = db.query(models.Subject).filter(models.Subject.code == subject.code).first()
+    existing_subject = await db.scalar(select(models.Subject).where(models.Subject.code == subject.code))
     if existing_subject:
         raise HTTPException(status_code=400, detail="Subject code already exists")
     
@@ -151,15 +447,15 @@ def create_subject(
         creator_id=current_user.id
     )
     db.add(new_subject)
-    db.commit()
-    db.refresh(new_subject)
+    await db.commit()
+    await db.refresh(new_subject)
     return new_subject
 
-@app.post("/subjects/{subject_id}/student/{student_id}", response_model=schemas.SubjectOut)
-def add_student_to_subject(
+@router.post("/subjects/{subject_id}/student/{student_id}", response_model=schemas.SubjectOut)
+async def add_student_to_subject(
     subject_id: int,
     student_id: int,  # The student ID to add to the subject
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_db),
     current_user: models.User = Depends(get_current_user)
 ):
     # Ensure only teachers can add students to subjects
@@ -167,183 +463,201 @@ def add_student_to_subject(
         raise HTTPException(status_code=403, detail="Only teachers can add students to subjects")
     
     # Get the subject by ID
-    subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
+    subject = await db.scalar(select(models.Subject).where(models.Subject.id == subject_id))
     if not subject:
         raise HTTPException(status_code=404, detail="Subject not found")
     
     # Get the student by ID
-    student = db.query(models.User).filter(models.User.id == student_id, models.User.role == "Student").first()
+    student = await db.scalar(select(models.User).where(models.User.id == student_id, models.User.role == "student"))
     if not student:
         raise HTTPException(status_code=404, detail="Student not found or the user is not a student")
 
     # Add the student to the subject if not already added
-    if student in subject.students:
+    if await is_enrolled(db, subject.id, student.id):
         raise HTTPException(status_code=400, detail="Student is already enrolled in this subject")
     
     # Add the student to the subject
-    subject.students.append(student)
-    db.commit()
-    db.refresh(subject)
+    await enroll_student(db, subject.id, student.id)
+    await db.refresh(subject, ["students"])
 
     return subject
 
-@app.post("/subjects/{subject_code}", response_model=schemas.SubjectOut)
-def join_subject_using_code(
+@router.post("/subjects/{subject_code}", response_model=schemas.StudentSubjectOut)
+async def join_subject_using_code(
     subject_code: str,  # The subject code to join
-    student: models.User = Depends(get_current_user),  # Get the current student user
-    db: Session = Depends(get_db)
+    current_user: auth.UserSnapshot = Depends(get_current_user),  # Get the current student user
+    db: AsyncSession = Depends(get_db)
 ):
     # Ensure the user is a student
-    if student.role != "student":
+    if current_user.role != "student":
         raise HTTPException(status_code=403, detail="Only students can join subjects")
     
     # Get the subject by code
-    subject = db.query(models.Subject).filter(models.Subject.code == subject_code).first()
+    subject = await db.scalar(select(models.Subject).where(models.Subject.code == subject_code))
     if not subject:
         raise HTTPException(status_code=404, detail="Subject not found")
 
     # Check if the student is already enrolled in the subject
-    if student in subject.students:
+    if await is_enrolled(db, subject.id, current_user.id):
         raise HTTPException(status_code=400, detail="Student is already enrolled in this subject")
 
     # Add the student to the subject
-    subject.students.append(student)
-    db.commit()
-    db.refresh(subject)
+    await enroll_student(db, subject.id, current_user.id)
+    await db.refresh(subject, ["students"])
 
     return subject
 
-@app.post("/subjects/{subject_id}/assessments", response_model=schemas.AssessmentOut)
-def create_assessment(
+@router.post("/subjects/{subject_id}/students", response_model=schemas.BulkEnrollmentOut)
+async def bulk_add_students_to_subject(
+    subject_id: int,
+    roster: schemas.BulkEnrollment,
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    subject = await get_owned_subject(db, subject_id, current_user)
+    return await bulk_enroll(db, subject.id, roster.student_ids, roster.emails)
+
+@router.post("/subjects/{subject_id}/students/csv", response_model=schemas.BulkEnrollmentOut)
+async def bulk_add_students_to_subject_from_csv(
+    subject_id: int,
+    file: UploadFile = File(...),  # See parse_roster_csv for the accepted layouts
+    current_user: models.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    subject = await get_owned_subject(db, subject_id, current_user)
+
+    content = await file.read(uploads.MAX_UPLOAD_BYTES + 1)
+    if len(content) > uploads.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="Roster file is too large")
+    try:
+        text = content.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="Roster file must be UTF-8 encoded CSV")
+
+    student_ids, emails = parse_roster_csv(text)
+    return await bulk_enroll(db, subject.id, student_ids, emails)
+
+@router.post("/subjects/{subject_id}/assessments", response_model=schemas.AssessmentOut)
+async def create_assessment(
     subject_id: str,
     name: str = Form(...),
     description: str = Form(...),
     over: str = Form(...),
     attachment: UploadFile = File(None),
     current_user: models.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can create assessments")
     
-    subject = db.query(models.Subject).filter(models.Subject.id == subject_id).first()
+    subject = await db.scalar(select(models.Subject).where(models.Subject.id == subject_id))
     if not subject:
         raise HTTPException(status_code=404, detail="Subject not found")
 
-    file_path = None
+    stored = None
     if attachment:
-        try:
-            # Define the directory to store files
-            upload_dir = "files/teachers"
-            os.makedirs(upload_dir, exist_ok=True)  # Ensure the directory exists
-
-            # Sanitize the file name (e.g., replace spaces with underscores)
-            sanitized_filename = f"{subject_id}_{attachment.filename}".replace(" ", "_")
-            file_path = os.path.join(upload_dir, sanitized_filename)
-
-            # Save the file
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(attachment.file, buffer)
+        stored = await blobstore.store_upload(attachment)
 
-        except Exception as e:
-            # Handle any errors during the file upload process
-            raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
-
-    
     # Create the assessment
     new_assessment = models.Assessment(
         name=name,
         description=description,
         over=over,
-        attachment=file_path,
         subject_id=subject.id
     )
     
     db.add(new_assessment)
-    db.commit()
-    db.refresh(new_assessment)
+    if stored:
+        # The assessment id keeps same-named attachments in one subject apart
+        await db.flush()
+        sanitized_filename = f"{subject_id}_{new_assessment.id}_{uploads.sanitize_filename(attachment.filename)}"
+        new_assessment.attachment = f"files/teachers/{sanitized_filename}"
+        new_assessment.attachment_hash = stored.sha256
+        await blobstore.add_reference(db, stored)
+    await db.commit()
+    await response_cache.bump(f"subject:{subject.id}")
+    await db.refresh(new_assessment)
+    events.broker.publish(
+        [f"subject:{subject.id}"],
+        "assessment.created",
+        {"assessment_id": new_assessment.id, "subject_id": subject.id, "name": new_assessment.name},
+    )
     
     return new_assessment
 
-@app.post("/submission/{assessment_id}")
-def submit_assessment(
+@router.post("/submission/{assessment_id}")
+async def submit_assessment(
     assessment_id: int,
     file: UploadFile = File(...),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Ensure the current user is a student
     if current_user.role != "student":
         raise HTTPException(status_code=403, detail="Only students can submit assessments")
 
     # Check if the assessment exists
-    assessment = db.query(models.Assessment).filter(models.Assessment.id == assessment_id).first()
+    assessment = await db.scalar(select(models.Assessment).where(models.Assessment.id == assessment_id))
     if not assessment:
         raise HTTPException(status_code=404, detail="Assessment not found")
 
     # Verify the student is enrolled in the subject
-    subject = db.query(models.Subject).filter(models.Subject.id == assessment.subject_id).first()
-    if not subject:
-        raise HTTPException(status_code=404, detail="Subject not found")
-    
-    if current_user.id not in [student.id for student in subject.students]:
+    if not await is_enrolled(db, assessment.subject_id, current_user.id):
         raise HTTPException(status_code=403, detail="You are not enrolled in this subject")
 
-    # Handle file upload
-    file_path = None
-    try:
-        # Define the directory to store files
-        upload_dir = "files/students"
-        os.makedirs(upload_dir, exist_ok=True)  # Ensure the directory exists
-
-        # Sanitize the file name (e.g., replace spaces with underscores)
-        sanitized_filename = f"{assessment_id}_{current_user.id}_{file.filename}".replace(" ", "_")
-        file_path = os.path.join(upload_dir, sanitized_filename)
-
-        # Save the file
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-    except Exception as e:
-        # Handle any errors during the file upload process
-        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
-
-    # Check if the student has already submitted for this assessment
-    existing_submission = db.query(models.Submission).filter(
+    # Check if the student has already submitted for this assessment, before touching the disk
+    already_submitted = await db.scalar(select(exists().where(
         models.Submission.assessment_id == assessment_id,
         models.Submission.student_id == current_user.id
-    ).first()
+    )))
 
-    if existing_submission:
+    if already_submitted:
         raise HTTPException(status_code=400, detail="You have already submitted this assessment")
 
+    # Handle file upload
+    stored = await blobstore.store_upload(file)
+    sanitized_filename = f"{assessment_id}_{current_user.id}_{uploads.sanitize_filename(file.filename)}"
+
     # Create a new submission
     new_submission = models.Submission(
         student_id=current_user.id,
         assessment_id=assessment_id,
-        file_path=file_path
+        file_path=f"files/students/{sanitized_filename}",
+        file_hash=stored.sha256,
     )
 
     db.add(new_submission)
-    db.commit()
-    db.refresh(new_submission)
+    await blobstore.add_reference(db, stored)
+    await gradestats.record_submission(db, assessment_id)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # A concurrent request from the same student won the unique index
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="You have already submitted this assessment")
+    await db.refresh(new_submission)
+    events.broker.publish(
+        [f"subject:{assessment.subject_id}", f"student:{current_user.id}"],
+        "submission.created",
+        {"submission_id": new_submission.id, "assessment_id": assessment_id, "student_id": current_user.id},
+    )
 
     return {"message": "Submission successful", "submission": new_submission}
 
-@app.get("/submission/view/{submission_id}")
-def view_submission(
+@router.get("/submission/view/{submission_id}")
+async def view_submission(
     submission_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if the user is a student or teacher
     if current_user.role not in ["student", "teacher"]:
         raise HTTPException(status_code=403, detail="Access denied")
 
     # Retrieve the submission query
-    submission_query = db.query(models.Submission).filter(models.Submission.id == submission_id)
+    submission_query = select(models.Submission).where(models.Submission.id == submission_id)
 
-    submission = submission_query.first()
+    submission = await db.scalar(submission_query)
 
     # Check if submission exists
     if not submission:
@@ -362,24 +676,24 @@ def view_submission(
         "feedback": submission.feedback
     }
 
-@app.get("/submission/student/{assessment_id}")
-def student_submission(
+@router.get("/submission/student/{assessment_id}")
+async def student_submission(
     assessment_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if the user is a student or teacher
     if current_user.role not in ["student", "teacher"]:
         raise HTTPException(status_code=403, detail="Access denied")
 
     # Retrieve the submission
-    submission_query = db.query(models.Submission).filter(models.Submission.assessment_id == assessment_id)
+    submission_query = select(models.Submission).where(models.Submission.assessment_id == assessment_id)
 
     # If the user is a student, only fetch their submission
     if current_user.role == "student":
-        submission_query = submission_query.filter(models.Submission.student_id == current_user.id)
+        submission_query = submission_query.where(models.Submission.student_id == current_user.id)
 
-    submission = submission_query.first()
+    submission = await db.scalar(submission_query)
 
     # Check if submission exists
     if not submission:
@@ -399,23 +713,23 @@ def student_submission(
         "feedback": submission.feedback
     }
 
-@app.get("/submission/check/{assessment_id}")
-def student_submission_for_assessment(
+@router.get("/submission/check/{assessment_id}")
+async def student_submission_for_assessment(
     assessment_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if the user is a student or teacher
     if current_user.role != "student":
         raise HTTPException(status_code=403, detail="Access denied")
 
     # Retrieve submissions for the student in the given assessment
-    submission_query = db.query(models.Submission).filter(
+    submission_query = select(models.Submission).where(
         models.Submission.assessment_id == assessment_id,
         models.Submission.student_id == current_user.id
     )
 
-    submission = submission_query.first()
+    submission = await db.scalar(submission_query)
 
     # Check if submission exists
     if not submission:
@@ -430,30 +744,108 @@ def student_submission_for_assessment(
         "feedback": submission.feedback
     }
 
-@app.get("/submissions/view/{assessment_id}")
-def view_submissions(
+# Everything the student home page needs in one round trip, instead of
+# /student/subjects + /assessments/{id} per subject + /submission/check/{id} per assessment
+@router.get("/student/dashboard", response_model=schemas.StudentDashboard)
+async def student_dashboard(
+    request: Request,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Access denied")
+
+    rows = (
+        await db.execute(
+            select(
+                Subject.id,
+                Subject.name,
+                Subject.code,
+                Subject.creator_id,
+                models.Assessment.id.label("assessment_id"),
+                models.Assessment.name.label("assessment_name"),
+                models.Assessment.description,
+                models.Assessment.over,
+                models.Assessment.attachment,
+                models.Submission.id.label("submission_id"),
+                models.Submission.file_path,
+                models.Submission.score,
+                models.Submission.feedback,
+            )
+            .join(
+                models.student_subject,
+                and_(
+                    models.student_subject.c.subject_id == Subject.id,
+                    models.student_subject.c.student_id == current_user.id,
+                ),
+            )
+            .outerjoin(models.Assessment, models.Assessment.subject_id == Subject.id)
+            .outerjoin(
+                models.Submission,
+                and_(
+                    models.Submission.assessment_id == models.Assessment.id,
+                    models.Submission.student_id == current_user.id,
+                ),
+            )
+            .order_by(Subject.id, models.Assessment.id)
+        )
+    ).all()
+
+    subjects = {}
+    for row in rows:
+        subject = subjects.get(row.id)
+        if subject is None:
+            subject = subjects[row.id] = {
+                "id": row.id,
+                "name": row.name,
+                "code": row.code,
+                "creator_id": row.creator_id,
+                "assessments": [],
+            }
+        if row.assessment_id is None:
+            continue  # Subject without assessments yet
+        subject["assessments"].append({
+            "id": row.assessment_id,
+            "name": row.assessment_name,
+            "description": row.description,
+            "over": row.over,
+            "attachment": row.attachment,
+            "submission_exists": row.submission_id is not None,
+            "submission_id": row.submission_id,
+            "file_path": row.file_path,
+            "score": row.score,
+            "feedback": row.feedback,
+        })
+
+    # Conditional GET: an unchanged dashboard costs the query but no body
+    return cached_json_response(request, build_cached_response({"subjects": list(subjects.values())}))
+
+@router.get("/submissions/view/{assessment_id}")
+async def view_submissions(
     assessment_id: int,
+    limit: Optional[int] = Query(None, ge=1, le=500),  # Page size, all submissions when omitted
+    after_id: Optional[int] = None,  # Keyset cursor: the last submission_id of the previous page
+    status: Optional[GradeStatus] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Check if the user is a student or teacher
     if current_user.role not in ["student", "teacher"]:
         raise HTTPException(status_code=403, detail="Access denied")
 
     # Retrieve the assessment to ensure it exists
-    assessment = db.query(models.Assessment).filter(models.Assessment.id == assessment_id).first()
+    assessment = await db.scalar(select(models.Assessment).where(models.Assessment.id == assessment_id))
     if not assessment:
         raise HTTPException(status_code=404, detail="Assessment not found")
 
     # If the user is a student, only fetch their submission
     if current_user.role == "student":
-        submission = (
-            db.query(models.Submission)
-            .filter(
+        submission = await db.scalar(
+            select(models.Submission)
+            .where(
                 models.Submission.assessment_id == assessment_id,
                 models.Submission.student_id == current_user.id,
             )
-            .first()
         )
 
         # Check if submission exists
@@ -469,77 +861,198 @@ def view_submissions(
             "feedback": submission.feedback,
         }
 
-    # If the user is a teacher, fetch all submissions for the assessment
+    # If the user is a teacher, fetch the submissions together with their students in one query
     if current_user.role == "teacher":
-        submissions = (
-            db.query(models.Submission)
-            .filter(models.Submission.assessment_id == assessment_id)
-            .all()
+        query = (
+            select(
+                models.Submission.id,
+                models.Submission.file_path,
+                models.Submission.score,
+                models.Submission.feedback,
+                models.User.id.label("student_id"),
+                models.User.firstname,
+                models.User.lastname,
+                models.User.email,
+            )
+            .join(models.Submission.student)
+            .where(models.Submission.assessment_id == assessment_id)
+            .order_by(models.Submission.id)
         )
+        if after_id is not None:
+            query = query.where(models.Submission.id > after_id)
+        if status == GradeStatus.GRADED:
+            query = query.where(models.Submission.score.is_not(None))
+        elif status == GradeStatus.UNGRADED:
+            query = query.where(models.Submission.score.is_(None))
+        if limit is not None:
+            query = query.limit(limit)
+
+        rows = (await db.execute(query)).all()
 
         # If no submissions exist
-        if not submissions:
+        if not rows and after_id is None and status is None:
             raise HTTPException(status_code=404, detail="No submissions found for this assessment")
 
         # Format the response for teacher
-        result = []
-        for submission in submissions:
-            student = db.query(models.User).filter(models.User.id == submission.student_id).first()
-            result.append({
-                "submission_id": submission.id,
+        result = [
+            {
+                "submission_id": row.id,
                 "student": {
-                    "id": student.id,
-                    "name": f"{student.firstname} {student.lastname}",
-                    "email": student.email,
+                    "id": row.student_id,
+                    "name": f"{row.firstname} {row.lastname}",
+                    "email": row.email,
                 },
-                "file_path": submission.file_path,
-                "score": submission.score,
-                "feedback": submission.feedback,
-            })
+                "file_path": row.file_path,
+                "score": row.score,
+                "feedback": row.feedback,
+            }
+            for row in rows
+        ]
 
         return {
             "assessment_id": assessment_id,
             "assessment_name": assessment.name,
             "submissions": result,
+            # Pass as after_id to fetch the next page; None once the last page is reached
+            "next_after_id": rows[-1].id if limit is not None and len(rows) == limit else None,
         }
 
 
-@app.put("/submissions/{submission_id}/grade")
-def grade_submission(
+# Rows fetched per round trip when streaming exports from a server-side cursor
+STREAM_FETCH_SIZE = 500
+
+def archive_name(value) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(value or "")).strip("._") or "_"
+
+async def submission_archive_entries(assessment_id: int):
+    # Runs while the response streams, so it opens its own session
+    db = new_session()
+    try:
+        result = await db.stream(
+            select(
+                models.Submission.id,
+                models.Submission.file_path,
+                models.Submission.file_hash,
+                models.Submission.score,
+                models.User.id.label("student_id"),
+                models.User.lastname,
+                models.User.firstname,
+                models.User.email,
+            )
+            .join(models.Submission.student)
+            .where(models.Submission.assessment_id == assessment_id)
+            .order_by(models.User.lastname, models.User.firstname, models.User.id)
+            .execution_options(yield_per=STREAM_FETCH_SIZE)
+        )
+
+        manifest = io.StringIO()
+        writer = csv.writer(manifest)
+        writer.writerow(["submission_id", "student_id", "lastname", "firstname", "email", "score", "file", "sha256", "status"])
+        async for partition in result.partitions(STREAM_FETCH_SIZE):
+            for row in partition:
+                # Stored names are "{assessment_id}_{student_id}_{original name}"
+                original_name = os.path.basename(row.file_path or "").removeprefix(f"{assessment_id}_{row.student_id}_")
+                entry_name = f"{archive_name(row.lastname)}_{archive_name(row.firstname)}_{row.student_id}/{archive_name(original_name)}"
+                disk_path = blobstore.blob_path(row.file_hash) if row.file_hash else row.file_path
+                if disk_path and os.path.isfile(disk_path):
+                    status = "included"
+                    yield entry_name, disk_path
+                else:
+                    status = "missing"
+                writer.writerow([row.id, row.student_id, row.lastname, row.firstname, row.email, row.score, entry_name, row.file_hash, status])
+        yield "manifest.csv", manifest.getvalue().encode("utf-8")
+    finally:
+        await db.close()
+
+@router.get("/submissions/archive/{assessment_id}")
+async def download_submissions_archive(
+    assessment_id: int,
+    teacher: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if teacher.role != "teacher":
+        raise HTTPException(status_code=403, detail="Only teachers can download submissions")
+
+    row = (
+        await db.execute(
+            select(models.Assessment.name, models.Subject.creator_id, models.Subject.code)
+            .join(models.Subject, models.Subject.id == models.Assessment.subject_id)
+            .where(models.Assessment.id == assessment_id)
+        )
+    ).first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Assessment not found")
+    if row.creator_id != teacher.id:
+        raise HTTPException(status_code=403, detail="You are not authorized to download these submissions")
+
+    filename = f"{archive_name(row.code)}_{archive_name(row.name)}_submissions.zip"
+    return StreamingResponse(
+        exports.zip_stream(submission_archive_entries(assessment_id)),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def submission_event(submission_id, assessment_id, student_id, score, feedback):
+    return {
+        "submission_id": submission_id,
+        "assessment_id": assessment_id,
+        "student_id": student_id,
+        "score": score,
+        "feedback": feedback,
+    }
+
+def score_error(score, over) -> Optional[str]:
+    # Scores run from 0 to the assessment's maximum; older rows without one are out of 100
+    over = over if over is not None else 100
+    if not (0 <= score <= over):
+        return f"Score must be between 0 and {over}"
+    return None
+
+@router.put("/submissions/{submission_id}/grade")
+async def grade_submission(
     submission_id: int,
     grade_data: schemas.AssessmentFeedback,
     teacher: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     # Verify the user's role
     if teacher.role != "teacher":
         raise HTTPException(status_code=403, detail="Only teachers can grade submissions")
 
-    # Fetch the submission
-    submission = db.query(models.Submission).filter(models.Submission.id == submission_id).first()
+    # Fetch the submission, locked so the statistics see the score it had until this commit
+    submission = await db.scalar(
+        select(models.Submission).where(models.Submission.id == submission_id).with_for_update()
+    )
     if not submission:
         raise HTTPException(status_code=404, detail="Submission not found")
 
     # Verify the teacher is the creator of the subject related to this submission's assessment
-    assessment = db.query(models.Assessment).filter(models.Assessment.id == submission.assessment_id).first()
+    assessment = await db.scalar(select(models.Assessment).where(models.Assessment.id == submission.assessment_id))
     if not assessment:
         raise HTTPException(status_code=404, detail="Associated assessment not found")
 
-    subject = db.query(models.Subject).filter(models.Subject.id == assessment.subject_id).first()
+    subject = await db.scalar(select(models.Subject).where(models.Subject.id == assessment.subject_id))
     if not subject or subject.creator_id != teacher.id:
         raise HTTPException(status_code=403, detail="You are not authorized to grade this submission")
 
     # Update score and feedback for the submission
     if grade_data.score is not None:
-        if not (0 <= grade_data.score <= 100):
-            raise HTTPException(status_code=400, detail="Score must be between 0 and 100")
+        error = score_error(grade_data.score, assessment.over)
+        if error:
+            raise HTTPException(status_code=400, detail=error)
+        await gradestats.record_grades(db, [(submission.assessment_id, submission.score, grade_data.score)])
         submission.score = grade_data.score
     if grade_data.feedback:
         submission.feedback = grade_data.feedback
 
     # Commit changes to the database
-    db.commit()
-    db.refresh(submission)
+    await db.commit()
+    await db.refresh(submission)
+    events.broker.publish(
+        [f"subject:{subject.id}", f"student:{submission.student_id}"],
+        "submission.graded",
+        submission_event(submission.id, submission.assessment_id, submission.student_id, submission.score, submission.feedback),
+    )
 
     return {
         "message": "Submission graded successfully",
@@ -552,44 +1065,457 @@ def grade_submission(
         }
     }
 
+BATCH_GRADE_LIMIT = 1000
+
+@router.put("/submissions/grades", response_model=schemas.BatchGradeOut)
+async def grade_submissions(
+    batch: schemas.BatchGrade,
+    teacher: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    # Verify the user's role
+    if teacher.role != "teacher":
+        raise HTTPException(status_code=403, detail="Only teachers can grade submissions")
+    if len(batch.grades) > BATCH_GRADE_LIMIT:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_GRADE_LIMIT} grades can be submitted at once")
+
+    # Authorize every submission with one query against the subject creator
+    submission_ids = {entry.submission_id for entry in batch.grades}
+    rows = (
+        await db.execute(
+            select(
+                models.Submission.id,
+                models.Submission.assessment_id,
+                models.Submission.student_id,
+                models.Submission.score,
+                models.Submission.feedback,
+                models.Assessment.subject_id,
+                models.Assessment.over,
+                models.Subject.creator_id,
+            )
+            .join(models.Assessment, models.Assessment.id == models.Submission.assessment_id)
+            .join(models.Subject, models.Subject.id == models.Assessment.subject_id)
+            .where(models.Submission.id.in_(submission_ids))
+            # Current scores feed the statistics deltas: lock them until the commit
+            .with_for_update(of=models.Submission)
+        )
+    ).all()
+    found = {row.id: row for row in rows}
+
+    results = []
+    updates = []
+    score_changes = []
+    seen = set()
+    for entry in batch.grades:
+        row = found.get(entry.submission_id)
+        error = None
+        if entry.submission_id in seen:
+            error = "Submission appears more than once in this batch"
+        elif row is None:
+            error = "Submission not found"
+        elif row.creator_id != teacher.id:
+            error = "You are not authorized to grade this submission"
+        elif entry.score is not None:
+            error = score_error(entry.score, row.over)
+        seen.add(entry.submission_id)
+
+        if error:
+            results.append(schemas.GradeResult(submission_id=entry.submission_id, status="error", error=error))
+            continue
+
+        # Same semantics as grade_submission: only provided values overwrite the stored ones
+        values = {"id": entry.submission_id}
+        if entry.score is not None:
+            values["score"] = entry.score
+            score_changes.append((row.assessment_id, row.score, entry.score))
+        if entry.feedback:
+            values["feedback"] = entry.feedback
+        if len(values) > 1:
+            updates.append(values)
+        results.append(schemas.GradeResult(submission_id=entry.submission_id, status="graded"))
+
+    # Bulk UPDATE by primary key, committed as one transaction
+    if updates:
+        await db.execute(update(models.Submission), updates)
+        await gradestats.record_grades(db, score_changes)
+        await db.commit()
+        for values in updates:
+            row = found[values["id"]]
+            events.broker.publish(
+                [f"subject:{row.subject_id}", f"student:{row.student_id}"],
+                "submission.graded",
+                submission_event(
+                    row.id, row.assessment_id, row.student_id,
+                    values.get("score", row.score), values.get("feedback", row.feedback),
+                ),
+            )
+
+    graded = sum(result.status == "graded" for result in results)
+    return schemas.BatchGradeOut(graded=graded, failed=len(results) - graded, results=results)
+
+async def gradebook_rows(subject_id: int, assessment_ids: List[int]):
+    # Runs while the response streams, after the request's own session is gone, so it opens its own
+    db = new_session()
+    try:
+        query = (
+            select(
+                models.User.id,
+                models.User.lastname,
+                models.User.firstname,
+                models.User.email,
+                models.Submission.assessment_id,
+                models.Submission.score,
+            )
+            .select_from(models.student_subject)
+            .join(models.User, models.User.id == models.student_subject.c.student_id)
+            .outerjoin(
+                models.Submission,
+                and_(
+                    models.Submission.student_id == models.User.id,
+                    models.Submission.assessment_id.in_(assessment_ids),
+                ),
+            )
+            .where(models.student_subject.c.subject_id == subject_id)
+            .order_by(models.User.lastname, models.User.firstname, models.User.id)
+            .execution_options(yield_per=STREAM_FETCH_SIZE)
+        )
+        result = await db.stream(query)
+
+        # Rows arrive grouped by student; emit one line per student as soon as it is complete
+        student, scores = None, {}
+        async for partition in result.partitions(STREAM_FETCH_SIZE):
+            for row in partition:
+                if student is not None and row.id != student.id:
+                    yield [student.id, student.lastname, student.firstname, student.email] + [scores.get(assessment_id) for assessment_id in assessment_ids]
+                    scores = {}
+                student = row
+                if row.assessment_id is not None:
+                    scores[row.assessment_id] = row.score if row.score is not None else "ungraded"
+        if student is not None:
+            yield [student.id, student.lastname, student.firstname, student.email] + [scores.get(assessment_id) for assessment_id in assessment_ids]
+    finally:
+        await db.close()
+
+@router.get("/subjects/{subject_id}/gradebook")
+async def export_gradebook(
+    subject_id: int,
+    format: ExportFormat = ExportFormat.CSV,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    subject = await get_owned_subject(db, subject_id, current_user)
+
+    assessments = (
+        await db.execute(
+            select(models.Assessment.id, models.Assessment.name, models.Assessment.over)
+            .where(models.Assessment.subject_id == subject.id)
+            .order_by(models.Assessment.id)
+        )
+    ).all()
+    header = ["student_id", "lastname", "firstname", "email"] + [
+        f"{assessment.name} (/{assessment.over})" for assessment in assessments
+    ]
+    rows = gradebook_rows(subject.id, [assessment.id for assessment in assessments])
+
+    filename = re.sub(r"[^A-Za-z0-9_.-]", "_", subject.code or str(subject.id)) + "_gradebook"
+    if format == ExportFormat.XLSX:
+        return StreamingResponse(
+            exports.xlsx_stream(header, rows, sheet_name=subject.name or "Gradebook"),
+            media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+            headers={"Content-Disposition": f'attachment; filename="{filename}.xlsx"'},
+        )
+    return StreamingResponse(
+        exports.csv_stream(header, rows),
+        media_type="text/csv",
+        headers={"Content-Disposition": f'attachment; filename="{filename}.csv"'},
+    )
+
 # Endpoint for teachers to get all subjects they created
-@app.get("/teacher/subjects", response_model=List[schemas.SubjectOut])
-def get_teacher_subjects(current_user: schemas.UserOut = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.get("/teacher/subjects", response_model=List[schemas.SubjectOut])
+async def get_teacher_subjects(current_user: schemas.UserOut = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if current_user.role != "teacher":
         raise HTTPException(status_code=403, detail="Not authorized")
     
     # Get all subjects created by the teacher
-    subjects = db.query(Subject).filter(Subject.creator_id == current_user.id).all()
+    subjects = (
+        await db.scalars(
+            select(Subject)
+            .options(selectinload(Subject.students))
+            .where(Subject.creator_id == current_user.id)
+        )
+    ).all()
     return subjects
 
 # Endpoint for students to get only the subjects they are enrolled in
-@app.get("/student/subjects", response_model=List[schemas.SubjectOut])
-def get_student_subjects(current_user: schemas.UserOut = Depends(get_current_user), db: Session = Depends(get_db)):
+@router.get("/student/subjects", response_model=List[schemas.StudentSubjectOut])
+async def get_student_subjects(current_user: schemas.UserOut = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     if current_user.role != "student":
         raise HTTPException(status_code=403, detail="Not authorized")
     
     # Get all subjects where the student is enrolled
-    subjects = db.query(Subject).join(Subject.students).filter(User.id == current_user.id).all()
+    subjects = (
+        await db.scalars(
+            select(Subject)
+            .join(Subject.students)
+            .options(selectinload(Subject.students))
+            .where(User.id == current_user.id)
+        )
+    ).all()
     return subjects
 
-@app.get("/assessments/{subject_id}", response_model=List[schemas.AssessmentOut])
-def get_assessments_by_subject(
+async def subject_summary_page(db: AsyncSession, query, limit: int):
+    # Counts come from correlated aggregates, so no roster or assessment rows are loaded
+    student_count = (
+        select(func.count())
+        .select_from(models.student_subject)
+        .where(models.student_subject.c.subject_id == Subject.id)
+        .correlate(Subject)
+        .scalar_subquery()
+    )
+    assessment_count = (
+        select(func.count())
+        .select_from(models.Assessment)
+        .where(models.Assessment.subject_id == Subject.id)
+        .correlate(Subject)
+        .scalar_subquery()
+    )
+    rows = (
+        await db.execute(
+            query.add_columns(
+                student_count.label("student_count"),
+                assessment_count.label("assessment_count"),
+            )
+            .order_by(Subject.id)
+            .limit(limit)
+        )
+    ).all()
+    items = [
+        schemas.SubjectSummary(
+            id=row.id,
+            name=row.name,
+            code=row.code,
+            creator_id=row.creator_id,
+            student_count=row.student_count,
+            assessment_count=row.assessment_count,
+        )
+        for row in rows
+    ]
+    return schemas.SubjectSummaryPage(items=items, next_after_id=items[-1].id if len(items) == limit else None)
+
+def subject_columns_after(after_id: Optional[int]):
+    query = select(Subject.id, Subject.name, Subject.code, Subject.creator_id)
+    if after_id is not None:
+        query = query.where(Subject.id > after_id)
+    return query
+
+# Compact variants of /teacher/subjects and /student/subjects: counts instead of embedded rosters
+@router.get("/teacher/subjects/summary", response_model=schemas.SubjectSummaryPage)
+async def get_teacher_subject_summaries(
+    limit: int = Query(50, ge=1, le=500),
+    after_id: Optional[int] = None,
+    current_user: schemas.UserOut = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if current_user.role != "teacher":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    query = subject_columns_after(after_id).where(Subject.creator_id == current_user.id)
+    return await subject_summary_page(db, query, limit)
+
+@router.get("/student/subjects/summary", response_model=schemas.SubjectSummaryPage)
+async def get_student_subject_summaries(
+    limit: int = Query(50, ge=1, le=500),
+    after_id: Optional[int] = None,
+    current_user: schemas.UserOut = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    if current_user.role != "student":
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    query = (
+        subject_columns_after(after_id)
+        .join(models.student_subject, models.student_subject.c.subject_id == Subject.id)
+        .where(models.student_subject.c.student_id == current_user.id)
+    )
+    return await subject_summary_page(db, query, limit)
+
+# The creator gets the full roster, enrolled students their classmates' names only
+@router.get("/subjects/{subject_id}/students", response_model=Union[schemas.RosterPage, schemas.ClassmatePage])
+async def get_subject_roster(
     subject_id: int,
-    db: Session = Depends(get_db),
+    limit: int = Query(100, ge=1, le=500),
+    after_id: Optional[int] = None,  # Keyset cursor: the last student id of the previous page
+    current_user: schemas.UserOut = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
 ):
-    assessments = db.query(models.Assessment).filter(models.Assessment.subject_id == subject_id).all()
-    return assessments
+    subject = await db.scalar(select(models.Subject).where(models.Subject.id == subject_id))
+    if not subject:
+        raise HTTPException(status_code=404, detail="Subject not found")
+    if subject.creator_id != current_user.id and not await is_enrolled(db, subject.id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not authorized")
 
-@app.get("/assessments/id/{assessment_id}", response_model=schemas.AssessmentOut)
-def get_assessment_by_id(
+    query = (
+        select(models.User)
+        .join(models.student_subject, models.student_subject.c.student_id == models.User.id)
+        .where(models.student_subject.c.subject_id == subject.id)
+        .order_by(models.User.id)
+        .limit(limit)
+    )
+    if after_id is not None:
+        query = query.where(models.User.id > after_id)
+    students = (await db.scalars(query)).all()
+    next_after_id = students[-1].id if len(students) == limit else None
+    if subject.creator_id == current_user.id:
+        return {"items": students, "next_after_id": next_after_id}
+    return schemas.ClassmatePage(
+        items=[schemas.Classmate(id=student.id, firstname=student.firstname, lastname=student.lastname) for student in students],
+        next_after_id=next_after_id,
+    )
+
+def assessment_payload(assessment):
+    return {
+        "id": assessment.id,
+        "name": assessment.name,
+        "description": assessment.description,
+        "over": assessment.over,
+        "attachment": assessment.attachment,
+    }
+
+def cached_json_response(request: Request, cached: cache.CachedResponse, cache_control: str = "private, no-cache") -> Response:
+    # By default clients may keep the body but have to revalidate it on every poll, which costs a 304 at most
+    headers = {"etag": cached.etag, "cache-control": cache_control}
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None and fileserve.etag_matches(if_none_match, cached.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=cached.body, media_type="application/json", headers=headers)
+
+def build_cached_response(payload) -> cache.CachedResponse:
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return cache.CachedResponse(etag=f'"{hashlib.sha256(body).hexdigest()[:32]}"', body=body)
+
+@router.get("/metrics/response-cache")
+async def response_cache_metrics():
+    return response_cache.stats()
+
+@router.get("/assessments/{subject_id}", response_model=List[schemas.AssessmentOut])
+async def get_assessments_by_subject(
+    subject_id: int,
+    request: Request,
+    db: AsyncSession = Depends(get_primary_db),
+):
+    # Cache misses read the primary: a lagging replica would store old data under the current version
+    key = f"assessments:subject:{subject_id}"
+    cached = await response_cache.get(key)
+    if cached is None:
+        scope = f"subject:{subject_id}"
+        version = await response_cache.version(scope)
+        assessments = (await db.scalars(select(models.Assessment).where(models.Assessment.subject_id == subject_id))).all()
+        cached = build_cached_response([assessment_payload(assessment) for assessment in assessments])
+        await response_cache.set(key, scope, version, cached)
+    return cached_json_response(request, cached)
+
+@router.get("/assessments/id/{assessment_id}", response_model=schemas.AssessmentOut)
+async def get_assessment_by_id(
     assessment_id: int,
-    db: Session = Depends(get_db),
+    request: Request,
+    db: AsyncSession = Depends(get_primary_db),
 ):
-    assessment = db.query(models.Assessment).filter(models.Assessment.id == assessment_id).first()
-    if assessment is None:
+    key = f"assessments:id:{assessment_id}"
+    cached = await response_cache.get(key)
+    if cached is None:
+        # The subject is only known once the row is loaded, so take the version of
+        # the subject it belonged to before the query and check it still matches after
+        subject_id = await db.scalar(select(models.Assessment.subject_id).where(models.Assessment.id == assessment_id))
+        if subject_id is None:
+            raise HTTPException(status_code=404, detail="Assessment not found")
+        scope = f"subject:{subject_id}"
+        version = await response_cache.version(scope)
+        assessment = await db.scalar(select(models.Assessment).where(models.Assessment.id == assessment_id))
+        if assessment is None:
+            raise HTTPException(status_code=404, detail="Assessment not found")
+        cached = build_cached_response(assessment_payload(assessment))
+        if assessment.subject_id == subject_id:
+            await response_cache.set(key, scope, version, cached)
+    return cached_json_response(request, cached)
+
+@router.get("/assessments/id/{assessment_id}/stats", response_model=schemas.AssessmentStatsOut)
+async def get_assessment_stats(
+    assessment_id: int,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    # Reads the maintained totals (see gradestats), never the submissions themselves
+    enrolled = (
+        select(func.count())
+        .select_from(models.student_subject)
+        .where(models.student_subject.c.subject_id == models.Assessment.subject_id)
+        .correlate(models.Assessment)
+        .scalar_subquery()
+    )
+    row = (
+        await db.execute(
+            select(
+                models.Assessment.over,
+                models.Subject.creator_id,
+                enrolled.label("enrolled"),
+                models.AssessmentStats.submitted,
+                models.AssessmentStats.graded,
+                models.AssessmentStats.score_sum,
+            )
+            .join(models.Subject, models.Subject.id == models.Assessment.subject_id)
+            .outerjoin(models.AssessmentStats, models.AssessmentStats.assessment_id == models.Assessment.id)
+            .where(models.Assessment.id == assessment_id)
+        )
+    ).first()
+    if not row:
         raise HTTPException(status_code=404, detail="Assessment not found")
-    return assessment
+    if current_user.role != "teacher" or row.creator_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    frequencies = (
+        await db.execute(
+            select(models.AssessmentScoreCount.score, models.AssessmentScoreCount.frequency)
+            .where(models.AssessmentScoreCount.assessment_id == assessment_id)
+            .order_by(models.AssessmentScoreCount.score)
+        )
+    ).all()
+    return gradestats.summarize(
+        assessment_id, row.over, row.enrolled, row.submitted or 0, row.graded or 0, row.score_sum or 0, frequencies
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if CREATE_SCHEMA:
+        await run_in_threadpool(create_schema)
+    events.drain_on_exit_signals()
+    yield
+    # Requests have drained by now: release the pools before the process exits
+    events.broker.close()
+    await run_in_threadpool(hashing.shutdown)
+    await database.dispose_engines()
+
+
+def create_app() -> FastAPI:
+    application = FastAPI(title="Appdev Classroom ", description="Google Classroom Clone", lifespan=lifespan)
+    # Inside CORS, so that browsers can read the 429/503 answers
+    application.add_middleware(admission.AdmissionMiddleware, routes=router.routes)
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=origins,  # Allows only these origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all HTTP methods
+        allow_headers=["*"],  # Allows all headers
+    )
+    # Outermost, so the timings include CORS handling and streamed bodies
+    application.add_middleware(metrics.MetricsMiddleware)
+    application.include_router(router)
+    return application
+
+
+app = create_app()
 
 
+# Development server; see serve.py for running with several workers
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,204 @@
+"""Per-request latency, status and database instrumentation.
+
+MetricsMiddleware times every request under its route template (e.g.
+/submission/view/{submission_id}) and instrument_engine() counts the SQL
+statements each request runs through a context variable. render() produces
+the Prometheus text exposition served at /metrics. Figures are per process;
+with several workers, scrape each one or aggregate on the Prometheus side.
+"""
+import contextvars
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import event
+
+logger = logging.getLogger("metrics")
+
+# Log requests slower than this many seconds, with their slowest statements (0 turns it off)
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", 0))
+SLOW_REQUEST_STATEMENTS = 3
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum:.6f}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class RequestStats:
+    """What one request did in the database; shared with the threads and greenlets it runs queries in."""
+
+    __slots__ = ("queries", "db_seconds", "slowest")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.slowest = []  # (seconds, statement), longest first
+
+    def record(self, statement, seconds):
+        self.queries += 1
+        self.db_seconds += seconds
+        if SLOW_REQUEST_SECONDS and (
+            len(self.slowest) < SLOW_REQUEST_STATEMENTS or seconds > self.slowest[-1][0]
+        ):
+            self.slowest.append((seconds, statement))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[SLOW_REQUEST_STATEMENTS:]
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+# Aggregates, only touched from the event loop
+in_flight = 0
+request_latency = defaultdict(lambda: Histogram(LATENCY_BUCKETS))  # (method, route)
+request_queries = defaultdict(lambda: Histogram(QUERY_COUNT_BUCKETS))  # (method, route)
+db_seconds = defaultdict(float)  # (method, route)
+responses = defaultdict(int)  # (method, route, status)
+
+
+# The start time lives on the statement's execution context rather than on a
+# per-connection stack, which a failing statement would never pop
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "metrics_started", None)
+    stats = current_request.get()
+    if stats is not None and started is not None:
+        stats.record(statement, time.perf_counter() - started)
+
+
+def instrument_engine(engine):
+    """Attribute the statements run on engine to the request executing them (pass async_engine.sync_engine for async)."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def _route_template(scope):
+    route = scope.get("route")
+    # Unmatched paths share one label so that scanners cannot blow up the series count
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware, so streamed responses are timed until their last chunk."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        global in_flight
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        in_flight += 1
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight -= 1
+            current_request.reset(token)
+            elapsed = time.perf_counter() - start
+            key = (scope["method"], _route_template(scope))
+            request_latency[key].observe(elapsed)
+            request_queries[key].observe(stats.queries)
+            db_seconds[key] += stats.db_seconds
+            responses[key + (status,)] += 1
+            if SLOW_REQUEST_SECONDS and elapsed >= SLOW_REQUEST_SECONDS:
+                _log_slow_request(key, status, elapsed, stats)
+
+
+def _log_slow_request(key, status, elapsed, stats):
+    statements = "".join(
+        f"\n  {seconds * 1000:.1f} ms: {' '.join(statement.split())[:300]}" for seconds, statement in stats.slowest
+    )
+    logger.warning(
+        "slow request %s %s -> %s in %.3f s, %d queries, %.3f s in the database%s",
+        *key, status, elapsed, stats.queries, stats.db_seconds, statements,
+    )
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(method, route):
+    return f'method="{method}",route="{_escape(route)}"'
+
+
+def _gauges(prefix, values):
+    # Flattens nested stats dicts; non-numeric entries (settings such as the executor name) are skipped
+    for name, value in values.items():
+        if isinstance(value, dict):
+            yield from _gauges(f"{prefix}_{name}", value)
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}_{name} {float(value)}"
+
+
+def render(components=None) -> str:
+    """Prometheus text format; components maps a name to another module's stats() dict."""
+    lines = [
+        "# HELP http_requests_in_flight Requests being processed.",
+        "# TYPE http_requests_in_flight gauge",
+        f"http_requests_in_flight {in_flight}",
+        "# HELP http_request_duration_seconds Time to the last byte of the response.",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, route), histogram in sorted(request_latency.items()):
+        lines.extend(histogram.lines("http_request_duration_seconds", _labels(method, route)))
+    lines += [
+        "# HELP http_responses_total Responses by status code.",
+        "# TYPE http_responses_total counter",
+    ]
+    for (method, route, status), count in sorted(responses.items()):
+        lines.append(f'http_responses_total{{{_labels(method, route)},status="{status}"}} {count}')
+    lines += [
+        "# HELP http_request_db_queries SQL statements executed per request.",
+        "# TYPE http_request_db_queries histogram",
+    ]
+    for (method, route), histogram in sorted(request_queries.items()):
+        lines.extend(histogram.lines("http_request_db_queries", _labels(method, route)))
+    lines += [
+        "# HELP http_request_db_seconds_total Time spent executing SQL statements.",
+        "# TYPE http_request_db_seconds_total counter",
+    ]
+    for (method, route), seconds in sorted(db_seconds.items()):
+        lines.append(f"http_request_db_seconds_total{{{_labels(method, route)}}} {seconds:.6f}")
+    for name, values in (components or {}).items():
+        lines.extend(_gauges(f"devclassroom_{name}", values))
+    return "\n".join(lines) + "\n"
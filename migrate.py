@@ -0,0 +1,111 @@
+"""One-off schema migrations for databases created before the current models.
+
+create_all only creates missing tables, so constraints added to existing
+tables are applied here. Every migration is idempotent; run with:
+
+    python migrate.py
+"""
+import logging
+
+from sqlalchemy import inspect, select, func, delete, text, table, column
+
+from database import engine, Base
+import models
+import blobstore
+import gradestats
+
+logger = logging.getLogger("migrate")
+
+
+def enrollment_primary_key(conn):
+    # Rebuild student_subject with its composite primary key, dropping duplicate rows
+    if inspect(conn).get_pk_constraint("student_subject").get("constrained_columns"):
+        return
+    conn.execute(text("ALTER TABLE student_subject RENAME TO student_subject_old"))
+    models.student_subject.create(conn)
+    old = table("student_subject_old", column("student_id"), column("subject_id"))
+    conn.execute(
+        models.student_subject.insert().from_select(
+            ["student_id", "subject_id"],
+            select(old.c.student_id, old.c.subject_id)
+            .where(old.c.student_id.is_not(None), old.c.subject_id.is_not(None))
+            .distinct(),
+        )
+    )
+    conn.execute(text("DROP TABLE student_subject_old"))
+    logger.info("student_subject: added primary key (student_id, subject_id)")
+
+
+def submission_unique_index(conn):
+    index_names = {index["name"] for index in inspect(conn).get_indexes("submissions")}
+    if "ix_submissions_assessment_student" in index_names:
+        return
+
+    # Keep one submission per (assessment, student): the graded one if any, else the oldest
+    Submission = models.Submission
+    duplicates = conn.execute(
+        select(Submission.assessment_id, Submission.student_id)
+        .group_by(Submission.assessment_id, Submission.student_id)
+        .having(func.count() > 1)
+    ).all()
+    for assessment_id, student_id in duplicates:
+        ids = conn.execute(
+            select(Submission.id)
+            .where(Submission.assessment_id == assessment_id, Submission.student_id == student_id)
+            .order_by(Submission.score.is_(None), Submission.id)
+        ).scalars().all()
+        conn.execute(delete(Submission).where(Submission.id.in_(ids[1:])))
+        logger.info(
+            "submissions: removed %d duplicate(s) for assessment %s, student %s",
+            len(ids) - 1, assessment_id, student_id,
+        )
+
+    for index in Submission.__table__.indexes:
+        if index.name == "ix_submissions_assessment_student":
+            index.create(conn)
+    logger.info("submissions: added unique index (assessment_id, student_id)")
+
+
+def blob_columns(conn):
+    # Hash columns that point submissions and attachments at the blob store
+    for table, names in [
+        (models.Submission.__table__, ["file_hash"]),
+        (models.Assessment.__table__, ["attachment_hash"]),
+    ]:
+        existing = {column["name"] for column in inspect(conn).get_columns(table.name)}
+        for name in names:
+            if name not in existing:
+                column = table.c[name]
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {name} {column_type}"))
+                logger.info("%s: added column %s", table.name, name)
+
+        index_names = {index["name"] for index in inspect(conn).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(conn)
+                logger.info("%s: added index %s", table.name, index.name)
+
+
+MIGRATIONS = [
+    enrollment_primary_key,
+    submission_unique_index,
+    blob_columns,
+    blobstore.import_legacy_files,
+    gradestats.backfill,
+]
+
+
+def run(bind=engine):
+    Base.metadata.create_all(bind=bind)
+    for migration in MIGRATIONS:
+        with bind.begin() as conn:
+            after_commit = migration(conn)
+        # File changes a rollback could not undo run only once the migration has committed
+        if after_commit:
+            after_commit()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    run()
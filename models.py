@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Table, Enum, Text
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Table, Enum, Text, Index
 from sqlalchemy.orm import relationship
 from database import Base
 import enum
@@ -7,8 +7,8 @@ from pydantic import BaseModel
 student_subject = Table(
     'student_subject',
     Base.metadata,
-    Column('student_id', Integer, ForeignKey('users.id')),
-    Column('subject_id', Integer, ForeignKey('subjects.id'))
+    Column('student_id', Integer, ForeignKey('users.id'), primary_key=True),
+    Column('subject_id', Integer, ForeignKey('subjects.id'), primary_key=True, index=True)
 )
 
 class User(Base):
@@ -57,7 +57,8 @@ class Assessment(Base):
     description = Column(Text)
     over = Column(Integer, nullable=True)
     feedback = Column(Text, nullable=True)
-    attachment = Column(String(100), nullable=True)
+    attachment = Column(String(100), nullable=True, index=True)  # Human-facing path, see Blob
+    attachment_hash = Column(String(64), nullable=True, index=True)
     subject_id = Column(Integer, ForeignKey("subjects.id"))
     
     subject = relationship("Subject", back_populates="assessments")
@@ -65,13 +66,47 @@ class Assessment(Base):
 
 class Submission(Base):
     __tablename__ = "submissions"
+    __table_args__ = (
+        # One submission per student per assessment; also serves the (assessment, student) lookups
+        Index("ix_submissions_assessment_student", "assessment_id", "student_id", unique=True),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     score = Column(Integer, nullable=True)
     feedback = Column(Text, nullable=True)
-    file_path = Column(String(100), nullable=True)
+    file_path = Column(String(100), nullable=True, index=True)  # Human-facing path, see Blob
+    file_hash = Column(String(64), nullable=True, index=True)
     student_id = Column(Integer, ForeignKey("users.id"))
     assessment_id = Column(Integer, ForeignKey('assessments.id'))
 
     student = relationship("User", back_populates="submissions")
     assessments = relationship("Assessment", back_populates="submissions")
+
+class Blob(Base):
+    """Content-addressed file stored once under files/blobs, keyed by its SHA-256.
+
+    Submission.file_hash and Assessment.attachment_hash point here; refcount
+    tracks how many of them do, so unreferenced blobs can be collected.
+    """
+    __tablename__ = "blobs"
+
+    sha256 = Column(String(64), primary_key=True)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)
+
+class AssessmentStats(Base):
+    """Running totals of an assessment's submissions, maintained by gradestats."""
+    __tablename__ = "assessment_stats"
+
+    assessment_id = Column(Integer, ForeignKey("assessments.id"), primary_key=True)
+    submitted = Column(Integer, nullable=False, default=0)
+    graded = Column(Integer, nullable=False, default=0)
+    score_sum = Column(Integer, nullable=False, default=0)
+
+class AssessmentScoreCount(Base):
+    """How many graded submissions of an assessment have each score."""
+    __tablename__ = "assessment_score_counts"
+
+    assessment_id = Column(Integer, ForeignKey("assessments.id"), primary_key=True)
+    score = Column(Integer, primary_key=True, autoincrement=False)
+    frequency = Column(Integer, nullable=False, default=0)
@@ -0,0 +1,235 @@
+"""Query budget check for the API routes.
+
+    python querybudget.py [--verbose]
+
+Seeds a scratch database twice, at a small and at a ten times larger
+roster/submission size, calls every route listed in CHECKS through a
+TestClient and counts the SQL statements it runs with engine events. A
+route fails when it exceeds its budget at either size or runs more
+statements on the larger dataset, which is how N+1 loads show up. Exits
+non-zero on any failure, so it can gate CI.
+
+Every route has a check except GET /events, whose stream stays open until the
+client leaves (its statements run once per connection, before streaming),
+and the /metrics routes, which read in-process counters only.
+
+The scratch database is QUERY_BUDGET_DATABASE_URL (a temporary SQLite file
+by default); it is dropped and recreated, so never point it at real data.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from argparse import Namespace
+from typing import Callable, NamedTuple
+
+SMALL = dict(teachers=3, students=20, subjects=4, subjects_per_student=2, assessments_per_subject=3, submission_rate=0.6)
+LARGE = dict(SMALL, students=200)
+
+
+class Check(NamedTuple):
+    budget: int
+    role: str  # Whose token to send: "teacher", "student" or None
+    method: str
+    path: str  # Formatted with the context ids, e.g. {subject_id}
+    body: Callable = lambda ctx: {}  # Extra TestClient keyword arguments
+
+    @property
+    def name(self):
+        return f"{self.method.upper()} {self.path}"
+
+
+# Budgets are per request, with the user and response caches cleared first;
+# reading the current user accounts for one statement in every authenticated route
+CHECKS = [
+    Check(3, None, "post", "/register", lambda ctx: {"json": {
+        "email": "budget@example.com", "password": "budget", "firstname": "Budget", "lastname": "Check", "role": "student",
+    }}),
+    Check(1, None, "post", "/login", lambda ctx: {"json": {"email": ctx["student_email"], "password": ctx["password"]}}),
+    Check(1, "student", "get", "/users/details"),
+    Check(1, None, "get", "/user/{student_id}"),
+    Check(1, None, "get", "/users/names?id={student_id}&id={teacher_id}"),
+    Check(3, "teacher", "get", "/teacher/subjects"),
+    Check(3, "student", "get", "/student/subjects"),
+    Check(2, "teacher", "get", "/teacher/subjects/summary"),
+    Check(2, "student", "get", "/student/subjects/summary"),
+    Check(3, "teacher", "get", "/subjects/{subject_id}/students"),
+    Check(4, "student", "get", "/subjects/{subject_id}/students?limit=50"),
+    Check(1, None, "get", "/assessments/{subject_id}"),
+    Check(2, None, "get", "/assessments/id/{assessment_id}"),
+    Check(2, "student", "get", "/submission/view/{submission_id}"),
+    Check(2, "student", "get", "/submission/student/{assessment_id}"),
+    Check(2, "student", "get", "/submission/check/{assessment_id}"),
+    Check(2, "student", "get", "/student/dashboard"),
+    Check(3, "teacher", "get", "/submissions/view/{assessment_id}"),
+    Check(3, "teacher", "get", "/submissions/archive/{assessment_id}"),
+    Check(4, "teacher", "get", "/subjects/{subject_id}/gradebook"),
+    Check(3, "teacher", "get", "/assessments/id/{assessment_id}/stats"),
+    Check(8, "teacher", "put", "/submissions/{submission_id}/grade", lambda ctx: {"json": {"score": 90, "feedback": "ok"}}),
+    Check(5, "teacher", "put", "/submissions/grades", lambda ctx: {
+        "json": {"grades": [{"submission_id": i, "score": 75} for i in ctx["assessment_submission_ids"]]}
+    }),
+    Check(4, "teacher", "post", "/subjects", lambda ctx: {"json": {"name": "Budget", "code": ctx["new_subject_code"]}}),
+    Check(6, "student", "post", "/subjects/{new_subject_code}"),
+    Check(7, "teacher", "post", "/subjects/{subject_id}/student/{unenrolled_student_id}"),
+    Check(5, "teacher", "post", "/subjects/{subject_id}/students", lambda ctx: {
+        "json": {"student_ids": ctx["unenrolled_student_ids"]}
+    }),
+    Check(5, "teacher", "post", "/subjects/{subject_id}/students/csv", lambda ctx: {
+        "files": {"file": ("roster.csv", "email\n" + "\n".join(ctx["unenrolled_student_emails"]))},
+    }),
+    Check(6, "teacher", "post", "/subjects/{subject_id}/assessments", lambda ctx: {
+        "data": {"name": "Budget", "description": "d", "over": "10"},
+        "files": {"attachment": ("brief.txt", b"brief")},
+    }),
+    Check(8, "student", "post", "/submission/{new_assessment_id}", lambda ctx: {
+        "files": {"file": ("work.txt", b"work")},
+    }),
+    Check(4, "student", "get", "/files/{new_attachment_path}"),
+]
+
+
+def context(conn, models, loadtest):
+    """Ids the checks refer to, picked the same way at both sizes."""
+    from sqlalchemy import select
+
+    user_ids = dict(conn.execute(select(models.User.email, models.User.id)).all())
+    teacher_id = user_ids[loadtest.email("teacher", 0)]
+    subject_id = conn.scalar(
+        select(models.Subject.id).where(models.Subject.creator_id == teacher_id).order_by(models.Subject.id)
+    )
+    assessment_id = conn.scalar(
+        select(models.Assessment.id).where(models.Assessment.subject_id == subject_id).order_by(models.Assessment.id)
+    )
+    submission_id, student_id = conn.execute(
+        select(models.Submission.id, models.Submission.student_id)
+        .where(models.Submission.assessment_id == assessment_id)
+        .order_by(models.Submission.id)
+    ).first()
+    enrolled = select(models.student_subject.c.student_id).where(models.student_subject.c.subject_id == subject_id)
+    unenrolled = conn.execute(
+        select(models.User.id, models.User.email)
+        .where(models.User.role == "student", models.User.id.not_in(enrolled))
+        .order_by(models.User.id)
+        .limit(10)
+    ).all()
+    return {
+        "teacher_id": teacher_id,
+        "teacher_email": loadtest.email("teacher", 0),
+        "student_id": student_id,
+        "student_email": conn.scalar(select(models.User.email).where(models.User.id == student_id)),
+        "subject_id": subject_id,
+        "assessment_id": assessment_id,
+        "submission_id": submission_id,
+        "assessment_submission_ids": conn.execute(
+            select(models.Submission.id).where(models.Submission.assessment_id == assessment_id)
+        ).scalars().all(),
+        # Split between the single, bulk and CSV enrollment checks
+        "unenrolled_student_id": unenrolled[0].id,
+        "unenrolled_student_ids": [row.id for row in unenrolled[1:5]],
+        "unenrolled_student_emails": [row.email for row in unenrolled[5:]],
+        "new_subject_code": "BUDGET",
+        "password": loadtest.PASSWORD,
+    }
+
+
+def measure(size, verbose):
+    from fastapi.testclient import TestClient
+    from sqlalchemy import event
+    import auth
+    import database
+    import loadtest
+    import main
+    import models
+
+    loadtest.seed(Namespace(seed=42, recreate=True, **size))
+    with database.engine.connect() as conn:
+        ctx = context(conn, models, loadtest)
+
+    statements = []
+
+    def count(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    for engine in (database.engine, database.async_engine.sync_engine):
+        event.listen(engine, "before_cursor_execute", count)
+
+    headers = {
+        "teacher": {"Authorization": f"Bearer {auth.create_access_token({'sub': ctx['teacher_email']})}"},
+        "student": {"Authorization": f"Bearer {auth.create_access_token({'sub': ctx['student_email']})}"},
+        None: {},
+    }
+    counts = {}
+    try:
+        with TestClient(main.app) as client:
+            for check in CHECKS:
+                auth.user_cache.clear()
+                auth.name_cache.clear()
+                main.response_cache.backend.entries.clear()
+                statements.clear()
+                response = getattr(client, check.method)(
+                    check.path.format(**ctx), headers=headers[check.role], **check.body(ctx)
+                )
+                response.read()
+                if response.status_code >= 400:
+                    sys.exit(f"{check.name} answered {response.status_code}: {response.text[:200]}")
+                if check.path == "/subjects/{subject_id}/assessments":
+                    ctx["new_assessment_id"] = response.json()["id"]
+                    ctx["new_attachment_path"] = response.json()["attachment"].removeprefix("files/")
+                counts[check.name] = len(statements)
+                if verbose:
+                    print(f"  {check.name}: {len(statements)}")
+                    for statement in statements:
+                        print(f"    {' '.join(statement.split())[:160]}")
+    finally:
+        for engine in (database.engine, database.async_engine.sync_engine):
+            event.remove(engine, "before_cursor_execute", count)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verbose", action="store_true", help="print every statement each route runs")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    # Work in a scratch directory so uploads and the default database stay out of the checkout
+    repo = os.path.dirname(os.path.abspath(__file__))
+    scratch = tempfile.mkdtemp(prefix="querybudget-")
+    sys.path.insert(0, repo)
+    os.chdir(scratch)
+    os.environ["DATABASE_URL"] = os.getenv("QUERY_BUDGET_DATABASE_URL", f"sqlite:///{scratch}/querybudget.db")
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    os.environ["RESPONSE_CACHE_URL"] = ""
+
+    try:
+        print(f"small dataset: {SMALL}")
+        small = measure(SMALL, args.verbose)
+        print(f"large dataset: {LARGE}")
+        large = measure(LARGE, args.verbose)
+    finally:
+        os.chdir(repo)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    failures = 0
+    print(f"{'route':<48} {'budget':>6} {'small':>6} {'large':>6}")
+    for check in CHECKS:
+        problems = []
+        if max(small[check.name], large[check.name]) > check.budget:
+            problems.append("over budget")
+        if large[check.name] > small[check.name]:
+            problems.append("grows with data")
+        failures += bool(problems)
+        print(
+            f"{check.name:<48} {check.budget:>6} {small[check.name]:>6} {large[check.name]:>6}"
+            f"{'  FAIL: ' + ', '.join(problems) if problems else ''}"
+        )
+    if failures:
+        sys.exit(f"{failures} route(s) broke their query budget")
+    print("all routes within budget")
+
+
+if __name__ == "__main__":
+    main()
@@ -47,6 +47,62 @@ class SubjectOut(BaseModel):
     class Config:
         orm_mode = True
 
+class SubjectSummary(BaseModel):
+    id: int
+    name: str
+    code: str
+    creator_id: int
+    student_count: int
+    assessment_count: int
+
+class SubjectSummaryPage(BaseModel):
+    items: List[SubjectSummary]
+    next_after_id: Optional[int]  # Pass as after_id to get the next page; None on the last page
+
+class RosterPage(BaseModel):
+    items: List[UserOut]
+    next_after_id: Optional[int]
+
+class Classmate(BaseModel):
+    # What students see of each other: no email address
+    id: int
+    firstname: str
+    lastname: str
+
+    class Config:
+        orm_mode = True
+
+class ClassmatePage(BaseModel):
+    items: List[Classmate]
+    next_after_id: Optional[int]
+
+class StudentSubjectOut(BaseModel):
+    # SubjectOut as students see it
+    id: int
+    name: str
+    code: str
+    creator_id: int
+    students: List[Classmate] = []
+
+    class Config:
+        orm_mode = True
+
+class BulkEnrollment(BaseModel):
+    student_ids: List[int] = []
+    emails: List[str] = []
+
+class EnrollmentResult(BaseModel):
+    student: str  # The id or email as it was given
+    student_id: Optional[int]
+    status: str  # "added", "already_enrolled" or "not_found"
+
+class BulkEnrollmentOut(BaseModel):
+    subject_id: int
+    added: int
+    already_enrolled: int
+    not_found: int
+    results: List[EnrollmentResult]
+
 class AssessmentCreate(BaseModel):
     name: str
     description: str
@@ -69,6 +125,24 @@ class AssessmentFeedback(BaseModel):
     class Config:
         orm_mode = True
 
+class GradeEntry(BaseModel):
+    submission_id: int
+    score: Optional[int] = None
+    feedback: Optional[str] = None
+
+class BatchGrade(BaseModel):
+    grades: List[GradeEntry]
+
+class GradeResult(BaseModel):
+    submission_id: int
+    status: str  # "graded" or "error"
+    error: Optional[str] = None
+
+class BatchGradeOut(BaseModel):
+    graded: int
+    failed: int
+    results: List[GradeResult]
+
 class AssessmentOut(BaseModel):
     id: int
     name: str
@@ -79,6 +153,42 @@ class AssessmentOut(BaseModel):
     class Config:
         orm_mode = True
 
+class DashboardAssessment(AssessmentOut):
+    # Same fields as /submission/check/{assessment_id}
+    submission_exists: bool
+    submission_id: Optional[int] = None
+    file_path: Optional[str] = None
+    score: Optional[int] = None
+    feedback: Optional[str] = None
+
+class DashboardSubject(BaseModel):
+    id: int
+    name: str
+    code: str
+    creator_id: int
+    assessments: List[DashboardAssessment]
+
+class StudentDashboard(BaseModel):
+    subjects: List[DashboardSubject]
+
+class HistogramBucket(BaseModel):
+    low: float
+    high: float
+    count: int
+
+class AssessmentStatsOut(BaseModel):
+    assessment_id: int
+    over: Optional[int]
+    enrolled: int
+    submitted: int
+    graded: int
+    submission_rate: Optional[float]
+    average: Optional[float]
+    median: Optional[float]
+    min: Optional[int]
+    max: Optional[int]
+    histogram: List[HistogramBucket]
+
 class Submission(BaseModel):
     score: Optional[int]
     feedback: Optional[str]
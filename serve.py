@@ -0,0 +1,140 @@
+"""Production entry point: several worker processes sharing one listening socket.
+
+    python serve.py [--workers 4] [--host 0.0.0.0] [--port 8000] [--server auto|gunicorn|uvicorn]
+
+With gunicorn installed (it does not run on Windows) the app is imported
+once in the parent and the workers fork from it already warm (preload);
+otherwise uvicorn's own supervisor starts every worker from scratch. Both
+use uvloop and httptools when they are installed (pip install
+"uvicorn[standard]") and fall back to asyncio and h11.
+
+The schema is created once here, before any worker starts, and the CPUs
+are shared out between the workers' bcrypt pools (HASH_WORKERS defaults to
+CPU count / workers). On SIGTERM the
+workers stop accepting connections, end the open event streams (clients
+reconnect to another worker), give the requests in flight up to
+--graceful-timeout seconds and then run the app's shutdown, which closes the
+database and hashing pools.
+"""
+import argparse
+import importlib.util
+import logging
+import os
+import warnings
+
+logger = logging.getLogger("serve")
+
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+# Same variable gunicorn and uvicorn read on their own
+WORKERS = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+BACKLOG = int(os.getenv("BACKLOG", 2048))
+KEEPALIVE_SECONDS = int(os.getenv("KEEPALIVE_SECONDS", 5))
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30))
+
+
+def installed(module: str) -> bool:
+    return importlib.util.find_spec(module) is not None
+
+
+def prepare(workers: int):
+    """Work done once in the parent, before any worker exists."""
+    # Every worker starts its own bcrypt pool: share the CPUs out between them
+    # rather than running workers * CPU count hashing processes
+    os.environ.setdefault("HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    import database
+    import main
+
+    main.create_schema()
+    # Forked workers must not inherit the parent's pooled connections
+    database.engine.dispose()
+    # Preloaded workers share this module state, spawned ones read the environment
+    main.CREATE_SCHEMA = False
+    os.environ["CREATE_SCHEMA"] = "0"
+
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    try:
+        from uvicorn_worker import UvicornWorker
+    except ImportError:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            from uvicorn.workers import UvicornWorker
+
+    class Worker(UvicornWorker):
+        def __init__(self, *worker_args, **worker_kwargs):
+            super().__init__(*worker_args, **worker_kwargs)
+            # Stop waiting for requests just before gunicorn kills the worker, so the app's shutdown still runs
+            self.config.timeout_graceful_shutdown = max(1, self.cfg.graceful_timeout - 1)
+
+    options = {
+        "bind": f"{args.host}:{args.port}",
+        "workers": args.workers,
+        "worker_class": Worker,
+        "preload_app": True,
+        "backlog": args.backlog,
+        "keepalive": args.keepalive,
+        "graceful_timeout": args.graceful_timeout,
+    }
+
+    class Application(BaseApplication):
+        def load_config(self):
+            for key, value in options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            import main
+            return main.app
+
+    Application().run()
+
+
+def run_uvicorn(args):
+    import uvicorn
+
+    uvicorn.run(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop" if installed("uvloop") else "asyncio",
+        http="httptools" if installed("httptools") else "h11",
+        backlog=args.backlog,
+        timeout_keep_alive=args.keepalive,
+        timeout_graceful_shutdown=args.graceful_timeout,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS, help="worker processes (WEB_CONCURRENCY)")
+    parser.add_argument("--server", choices=["auto", "gunicorn", "uvicorn"], default="auto",
+                        help="process manager; auto picks gunicorn when it is installed")
+    parser.add_argument("--backlog", type=int, default=BACKLOG, help="pending connections the socket queues")
+    parser.add_argument("--keepalive", type=int, default=KEEPALIVE_SECONDS, help="seconds an idle connection stays open")
+    parser.add_argument("--graceful-timeout", type=int, default=GRACEFUL_TIMEOUT,
+                        help="seconds requests in flight get to finish on shutdown")
+    args = parser.parse_args()
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
+
+    server = args.server
+    if server == "auto":
+        server = "gunicorn" if installed("gunicorn") else "uvicorn"
+    logger.info(
+        "serving on %s:%d with %d %s worker(s), %s loop, %s parser",
+        args.host, args.port, args.workers, server,
+        "uvloop" if installed("uvloop") else "asyncio", "httptools" if installed("httptools") else "h11",
+    )
+    prepare(args.workers)
+    if server == "gunicorn":
+        run_gunicorn(args)
+    else:
+        run_uvicorn(args)
+
+
+if __name__ == "__main__":
+    main()
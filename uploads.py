@@ -0,0 +1,74 @@
+import hashlib
+import os
+import tempfile
+from typing import NamedTuple
+
+from fastapi import HTTPException, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+# Upload settings
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 50 * 1024 * 1024))
+CHUNK_SIZE = 1024 * 1024
+
+
+class StoredUpload(NamedTuple):
+    path: str
+    size: int
+    sha256: str
+
+
+def sanitize_filename(filename: str) -> str:
+    # Drop any client supplied directories and replace spaces with underscores
+    return os.path.basename(filename or "upload").replace(" ", "_")
+
+
+def _write_chunk(buffer, digest, chunk):
+    digest.update(chunk)
+    buffer.write(chunk)
+
+
+def _discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+async def discard(path: str):
+    await run_in_threadpool(_discard, path)
+
+
+async def save_upload(upload: UploadFile, directory: str, filename: str, max_bytes: int = MAX_UPLOAD_BYTES) -> StoredUpload:
+    """Stream an upload to directory/filename, hashing it in the same pass.
+
+    The data goes to a temp file next to the destination and is renamed into
+    place only once it is complete, so readers never see a partial file and
+    failures leave nothing behind.
+    """
+    if upload.size is not None and upload.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes} byte limit")
+
+    await run_in_threadpool(os.makedirs, directory, exist_ok=True)
+    file_path = os.path.join(directory, filename)
+    fd, temp_path = await run_in_threadpool(tempfile.mkstemp, dir=directory, prefix=".upload-", suffix=".part")
+
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as buffer:
+            while chunk := await upload.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File exceeds the {max_bytes} byte limit")
+                await run_in_threadpool(_write_chunk, buffer, digest, chunk)
+        # mkstemp creates the file owner-only; give it the permissions open() would have
+        await run_in_threadpool(os.chmod, temp_path, 0o644)
+        await run_in_threadpool(os.replace, temp_path, file_path)
+    except HTTPException:
+        await discard(temp_path)
+        raise
+    except Exception as e:
+        await discard(temp_path)
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+
+    return StoredUpload(path=file_path, size=size, sha256=digest.hexdigest())